@@ -14,10 +14,10 @@ nav['Contribute']='contribute.md'
 nav['About']='about.md'
 
 for path in sorted(src.rglob("*.py")):
-    doc_path = "api" / path.relative_to(src).with_suffix(".md")
+    rel_path = path.relative_to(src)
+    doc_path = "api" / rel_path.with_suffix(".md")
     full_doc_path = Path(root, "docs", doc_path)
-    module_path = path.relative_to(src).with_suffix("")
-    parts = tuple(module_path.parts)
+    parts = rel_path.with_suffix("").parts
 
     if parts[-1] == "__init__":
         parts = parts[:-1]
@@ -9,10 +9,15 @@ levels (obtained by wavelet transform).
 import ast
 import json
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
 
 # externals
+import fsspec
 import glymur
 import nibabel as nib
+import numcodecs
 import numpy as np
 import zarr
 from cyclopts import App
@@ -21,8 +26,8 @@ from cyclopts import App
 # internals
 from linc_convert import utils
 from linc_convert.modalities.df.cli import df
-from linc_convert.utils.j2k import WrappedJ2K, get_pixelsize
-from linc_convert.utils.math import ceildiv, floordiv
+from linc_convert.utils.j2k import WrappedJ2K, get_pixelsize, read_header
+from linc_convert.utils.math import ceildiv
 from linc_convert.utils.orientation import center_affine, orientation_to_affine
 from linc_convert.utils.zarr.compressor import make_compressor
 from linc_convert.utils.zarr.zarr_config import ZarrConfig
@@ -38,6 +43,99 @@ ms = App(name="multislice", help_format="markdown")
 df.command(ms)
 
 
+def _tile_bounds(offset: int, size: int, max_load: int) -> list[tuple[int, int]]:
+    """Input bounds of the `max_load` output tiles covering [offset, offset+size)."""
+    first, last = offset // max_load, -(-(offset + size) // max_load)
+    return [
+        (max(k * max_load - offset, 0), min((k + 1) * max_load - offset, size))
+        for k in range(first, last)
+    ]
+
+
+def _write_slice(
+    idx: int,
+    inp1: str,
+    arrays: list[zarr.Array],
+    max_load: int | None,
+) -> None:
+    """Write all levels of one JPEG2000 slice into the `idx`-th slice."""
+    j2k = glymur.Jp2k(inp1)
+    for level, array in enumerate(arrays):
+        _write_level(idx, j2k, array, level, max_load)
+
+
+def _write_level(
+    idx: int,
+    j2k: glymur.Jp2k,
+    array: zarr.Array,
+    level: int,
+    max_load: int | None,
+) -> None:
+    """Write one JPEG2000 level into the `idx`-th slice of a Zarr level."""
+    shape = array.shape
+    subdat = WrappedJ2K(j2k, level=level)
+    subdat_size = subdat.shape
+    print(
+        "Convert level",
+        level,
+        "with shape",
+        shape,
+        "for slice",
+        idx,
+        "with size",
+        subdat_size,
+    )
+
+    # Decoded buffers are written as-is: a dtype mismatch would mean a
+    # silent (full-size) cast on every write.
+    if np.dtype(subdat.dtype) != array.dtype:
+        raise TypeError(
+            f"Slice {idx} has data type {np.dtype(subdat.dtype)} "
+            f"but the output has data type {array.dtype}"
+        )
+
+    # offset while attaching
+    x = (shape[-2] - subdat_size[-2]) // 2
+    y = (shape[-1] - subdat_size[-1]) // 2
+
+    # All components come out of a single codestream decode, so we
+    # read and write every channel at once (grayscale images have no
+    # leading channel axis). Only the channels of the output are kept,
+    # e.g. the RGB components of an RGBA image.
+    channels = (slice(0, shape[0]),) if len(subdat_size) > 2 else ()
+    if max_load is None or (subdat_size[-2] < max_load and subdat_size[-1] < max_load):
+        array[..., idx, x : x + subdat_size[-2], y : y + subdat_size[-1]] = subdat[
+            (*channels, Ellipsis)
+        ]
+    else:
+        # Tiles are laid on the output grid (`max_load` is a multiple of
+        # the chunk size) so that each chunk is written exactly once,
+        # without a read-modify-write of partially covered chunks.
+        tiles_x = _tile_bounds(x, subdat_size[-2], max_load)
+        tiles_y = _tile_bounds(y, subdat_size[-1], max_load)
+        tiles = [(*tile_x, *tile_y) for tile_x in tiles_x for tile_y in tiles_y]
+
+        def read_tile(tile: tuple[int, int, int, int]) -> np.ndarray:
+            start_x, end_x, start_y, end_y = tile
+            return subdat[(*channels, slice(start_x, end_x), slice(start_y, end_y))]
+
+        # Decode the next tile while the current one is compressed and
+        # written, so that at most two tiles are held in memory.
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            next_tile = reader.submit(read_tile, tiles[0])
+            for n, (start_x, end_x, start_y, end_y) in enumerate(tiles):
+                tile = next_tile.result()
+                if n + 1 < len(tiles):
+                    next_tile = reader.submit(read_tile, tiles[n + 1])
+
+                array[
+                    ...,
+                    idx,
+                    x + start_x : x + end_x,
+                    y + start_y : y + end_y,
+                ] = tile
+
+
 @ms.default
 def convert(
     inp: list[str],
@@ -48,6 +146,9 @@ def convert(
     orientation: str = "coronal",
     center: bool = True,
     thickness: float | None = None,
+    target_chunk_bytes: int | None = None,
+    compress_levels: Literal["all", "base", "none"] = "all",
+    max_workers: int | None = None,
         **kwargs
 ) -> None:
     """
@@ -88,13 +189,25 @@ def convert(
     out
         Path to the output Zarr directory [<INP>.ome.zarr]
     max_load
-        Maximum input chunk size
+        Maximum input chunk size (rounded up to a multiple of the
+        output chunk size)
     orientation
         Orientation of the slice
     center
         Set RAS[0, 0, 0] at FOV center
     thickness
         Slice thickness
+    target_chunk_bytes
+        Target size (in bytes) of an uncompressed output chunk.
+        If set, the in-plane chunk size is derived from it and overrides
+        the `chunk` option. Object stores work best with chunks of a
+        few MB.
+    compress_levels
+        Pyramid levels to compress: `"all"`, only the `"base"` level
+        (levels >= 1 are written uncompressed) or `"none"`.
+    max_workers
+        Number of slices converted in parallel (default: number of
+        CPUs). Each worker holds up to two decoded `max_load` tiles.
     """
     zarr_config = utils.zarr.zarr_config.update(zarr_config, **kwargs)
     chunk: int = zarr_config.chunk[0]
@@ -110,186 +223,217 @@ def convert(
 
     if isinstance(compressor_opt, str):
         compressor_opt = ast.literal_eval(compressor_opt)
-
-    # Prepare Zarr group
-    omz = zarr.storage.DirectoryStore(out)
-    omz = zarr.group(store=omz, overwrite=True)
-
-    nblevel, has_channel, dtype_jp2 = float("inf"), float("inf"), ""
-
-    # Compute output shape
-    new_height, new_width = 0, 0
-    for inp1 in inp:
-        jp2 = glymur.Jp2k(inp1)
-        nblevel = min(nblevel, jp2.codestream.segment[2].num_res)
-        has_channel = min(has_channel, jp2.ndim - 2)
-        dtype_jp2 = np.dtype(jp2.dtype).str
-        if jp2.shape[0] > new_height:
-            new_height = jp2.shape[0]
-        if jp2.shape[1] > new_width:
-            new_width = jp2.shape[1]
-    new_size = (new_height, new_width)
-    if has_channel:
-        new_size += (3,)
-    print(len(inp), new_size, nblevel, has_channel)
-
-    # Prepare chunking options
-    opt = {
-        "chunks": list(new_size[2:]) + [1] + [chunk, chunk],
-        "dimension_separator": r"/",
-        "order": "F",
-        "dtype": dtype_jp2,
-        "fill_value": 0,
-        "compressor": make_compressor(compressor, **compressor_opt),
-    }
-    print(opt)
-    print(new_size)
-    # Write each level
-    for level in range(nblevel):
-        shape = [ceildiv(s, 2**level) for s in new_size[:2]]
-        shape = [new_size[2]] + [len(inp)] + shape
-
-        omz.create_dataset(f"{level}", shape=shape, **opt)
-        array = omz[f"{level}"]
-
-        # Write each slice
-        for idx, inp1 in enumerate(inp):
-            j2k = glymur.Jp2k(inp1)
-            vxw, vxh = get_pixelsize(j2k)
-            subdat = WrappedJ2K(j2k, level=level)
-            subdat_size = subdat.shape
-            print(
-                "Convert level",
-                level,
-                "with shape",
-                shape,
-                "for slice",
-                idx,
-                "with size",
-                subdat_size,
-            )
-
-            # offset while attaching
-            x = floordiv(shape[-2] - subdat_size[-2], 2)
-            y = floordiv(shape[-1] - subdat_size[-1], 2)
-
-            for channel in range(3):
-                if max_load is None or (
-                    subdat_size[-2] < max_load and subdat_size[-1] < max_load
-                ):
-                    array[
-                        channel, idx, x : x + subdat_size[-2], y : y + subdat_size[-1]
-                    ] = subdat[channel : channel + 1, ...][0]
-                else:
-                    ni = ceildiv(subdat_size[-2], max_load)
-                    nj = ceildiv(subdat_size[-1], max_load)
-
-                    for i in range(ni):
-                        for j in range(nj):
-                            print(f"\r{i+1}/{ni}, {j+1}/{nj}", end=" ")
-                            start_x, end_x = (
-                                i * max_load,
-                                min((i + 1) * max_load, subdat_size[-2]),
-                            )
-                            start_y, end_y = (
-                                j * max_load,
-                                min((j + 1) * max_load, subdat_size[-1]),
-                            )
-
-                            array[
-                                channel,
-                                idx,
-                                x + start_x : x + end_x,
-                                y + start_y : y + end_y,
-                            ] = subdat[
-                                channel : channel + 1,
-                                start_x:end_x,
-                                start_y:end_y,
-                            ][0]
-
-                    print("")
-
-    # Write OME-Zarr multiscale metadata
-    print("Write metadata")
-    multiscales = [
-        {
-            "version": "0.4",
-            "axes": [
-                {"name": "z", "type": "space", "unit": "micrometer"},
-                {"name": "y", "type": "distance", "unit": "micrometer"},
-                {"name": "x", "type": "space", "unit": "micrometer"},
-            ],
-            "datasets": [],
-            "type": "jpeg2000",
-            "name": "",
+    if compressor == "blosc" and not compressor_opt:
+        # zstd + bitshuffle compresses 8/16-bit imagery much better than
+        # the blosclz + byte-shuffle defaults, at a similar speed.
+        compressor_opt = {
+            "cname": "zstd",
+            "clevel": 3,
+            "shuffle": numcodecs.Blosc.BITSHUFFLE,
         }
-    ]
-    if has_channel:
-        multiscales[0]["axes"].insert(0, {"name": "c", "type": "channel"})
 
-    for n in range(nblevel):
-        shape0 = omz["0"].shape[-2:]
-        shape = omz[str(n)].shape[-2:]
-        multiscales[0]["datasets"].append({})
-        level = multiscales[0]["datasets"][-1]
-        level["path"] = str(n)
+    # Remote outputs are staged in a local directory and uploaded at
+    # the end in one bulk (concurrent) transfer, rather than sending
+    # one request per chunk while converting.
+    remote = fsspec.utils.get_protocol(out) != "file"
+    if remote:
+        staging = tempfile.TemporaryDirectory()
+        store_path = os.path.join(staging.name, os.path.basename(out.rstrip("/")))
+    else:
+        store_path = out
+
+    try:
+        # Prepare Zarr group
+        # (FSStore hands all chunks of a write to the filesystem in a single
+        #  `setitems` batch)
+        omz = zarr.storage.FSStore(store_path)
+        omz = zarr.group(store=omz, overwrite=True)
+
+        nblevel, has_channel, dtype_jp2 = float("inf"), float("inf"), ""
+
+        # Compute output shape
+        # (only the codestream headers are read here; each file is fully
+        #  parsed once, by the worker that writes it)
+        new_height, new_width = 0, 0
+        for inp1 in inp:
+            jp2_shape, jp2_dtype, jp2_nblevel = read_header(inp1)
+            nblevel = min(nblevel, jp2_nblevel)
+            has_channel = min(has_channel, len(jp2_shape) - 2)
+            dtype_jp2 = jp2_dtype.str
+            if jp2_shape[0] > new_height:
+                new_height = jp2_shape[0]
+            if jp2_shape[1] > new_width:
+                new_width = jp2_shape[1]
+        new_size = (new_height, new_width)
+        if has_channel:
+            new_size += (3,)
+        print(len(inp), new_size, nblevel, has_channel)
+
+        if target_chunk_bytes:
+            # chunks hold all channels of a (chunk x chunk) tile
+            itemsize = np.dtype(dtype_jp2).itemsize * (3 if has_channel else 1)
+            chunk = int(np.sqrt(target_chunk_bytes / itemsize))
+
+        # Prepare chunking options
+        opt = {
+            "chunks": list(new_size[2:]) + [1] + [chunk, chunk],
+            "dimension_separator": r"/",
+            "order": "F",
+            "dtype": dtype_jp2,
+            "fill_value": 0,
+            "compressor": make_compressor(compressor, **compressor_opt),
+            # do not store the zero-filled chunks of the centering borders
+            "write_empty_chunks": False,
+        }
+        print(opt)
+        print(new_size)
+        # Align input tiles with output chunks
+        if max_load is not None:
+            max_load = ceildiv(max_load, chunk) * chunk
+
+        # Create each level
+        arrays = []
+        for level in range(nblevel):
+            shape = [ceildiv(s, 2**level) for s in new_size[:2]]
+            shape = list(new_size[2:]) + [len(inp)] + shape
+
+            level_opt = opt
+            if compress_levels == "none" or (compress_levels == "base" and level):
+                level_opt = {**opt, "compressor": None}
+            omz.create_dataset(f"{level}", shape=shape, **level_opt)
+            arrays.append(omz[f"{level}"])
+
+        # Decoding and compression run in worker threads, so Blosc must not
+        # spawn its own threads, and the remaining cores are shared between
+        # the OpenJPEG decoders to avoid oversubscription. These settings are
+        # process-wide: they are restored once the slices are written.
+        ncpu = os.cpu_count() or 1
+        max_workers = min(len(inp), max_workers or ncpu)
+        num_threads = max(1, ncpu // max_workers)
+        has_lib_threads = glymur.version.openjpeg_version_tuple >= (2, 2, 0)
+        prev_use_threads = numcodecs.blosc.use_threads
+        prev_opj_threads = os.environ.get("OPJ_NUM_THREADS")
+        if has_lib_threads:
+            prev_lib_threads = glymur.get_option("lib.num_threads")
+        numcodecs.blosc.use_threads = False
+        os.environ.setdefault("OPJ_NUM_THREADS", str(num_threads))
+        if has_lib_threads:
+            glymur.set_option("lib.num_threads", num_threads)
+
+        # Write each slice, all levels at once (slices map to disjoint chunks)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(
+                    executor.map(
+                        lambda args: _write_slice(
+                            *args, arrays=arrays, max_load=max_load
+                        ),
+                        enumerate(inp),
+                    )
+                )
+        finally:
+            numcodecs.blosc.use_threads = prev_use_threads
+            if prev_opj_threads is None:
+                os.environ.pop("OPJ_NUM_THREADS", None)
+            if has_lib_threads:
+                glymur.set_option("lib.num_threads", prev_lib_threads)
+        vxw, vxh = get_pixelsize(glymur.Jp2k(inp[-1]))
+
+        # Write OME-Zarr multiscale metadata
+        print("Write metadata")
+        multiscales = [
+            {
+                "version": "0.4",
+                "axes": [
+                    {"name": "z", "type": "space", "unit": "micrometer"},
+                    {"name": "y", "type": "distance", "unit": "micrometer"},
+                    {"name": "x", "type": "space", "unit": "micrometer"},
+                ],
+                "datasets": [],
+                "type": "jpeg2000",
+                "name": "",
+            }
+        ]
+        if has_channel:
+            multiscales[0]["axes"].insert(0, {"name": "c", "type": "channel"})
 
         # I assume that wavelet transforms end up aligning voxel edges
         # across levels, so the effective scaling is the shape ratio,
         # and there is a half voxel shift wrt to the "center of first voxel"
         # frame
-        level["coordinateTransformations"] = [
-            {
-                "type": "scale",
-                "scale": [1.0] * has_channel
-                + [
-                    1.0,
-                    (shape0[0] / shape[0]) * vxh,
-                    (shape0[1] / shape[1]) * vxw,
-                ],
-            },
+        level_shapes = [array.shape[-2:] for array in arrays]
+        shape0 = level_shapes[0]
+        multiscales[0]["datasets"] = [
             {
-                "type": "translation",
-                "translation": [0.0] * has_channel
-                + [
-                    0.0,
-                    (shape0[0] / shape[0] - 1) * vxh * 0.5,
-                    (shape0[1] / shape[1] - 1) * vxw * 0.5,
+                "path": str(n),
+                "coordinateTransformations": [
+                    {
+                        "type": "scale",
+                        "scale": [1.0] * has_channel
+                        + [
+                            1.0,
+                            (shape0[0] / shape[0]) * vxh,
+                            (shape0[1] / shape[1]) * vxw,
+                        ],
+                    },
+                    {
+                        "type": "translation",
+                        "translation": [0.0] * has_channel
+                        + [
+                            0.0,
+                            (shape0[0] / shape[0] - 1) * vxh * 0.5,
+                            (shape0[1] / shape[1] - 1) * vxw * 0.5,
+                        ],
+                    },
                 ],
-            },
+            }
+            for n, shape in enumerate(level_shapes)
         ]
-    multiscales[0]["coordinateTransformations"] = [
-        {"scale": [1.0] * (3 + has_channel), "type": "scale"}
-    ]
-    omz.attrs["multiscales"] = multiscales
-
-    # Write NIfTI-Zarr header
-    # NOTE: we use nifti2 because dimensions typically do not fit in a short
-    # TODO: we do not write the json zattrs, but it should be added in
-    #       once the nifti-zarr package is released
-    shape = list(reversed(omz["0"].shape))
-    if has_channel:
-        shape = shape[:3] + [1] + shape[3:]
-    affine = orientation_to_affine(orientation, vxw, vxh, thickness or 1)
-    if center:
-        affine = center_affine(affine, shape[:2])
-    header = nib.Nifti2Header()
-    header.set_data_shape(shape)
-    header.set_data_dtype(omz["0"].dtype)
-    header.set_qform(affine)
-    header.set_sform(affine)
-    header.set_xyzt_units(nib.nifti1.unit_codes.code["micron"])
-    header.structarr["magic"] = b"n+2\0"
-    header = np.frombuffer(header.structarr.tobytes(), dtype="u1")
-    opt = {
-        "chunks": [len(header)],
-        "dimension_separator": r"/",
-        "order": "F",
-        "dtype": "|u1",
-        "fill_value": None,
-        "compressor": None,
-    }
-    omz.create_dataset("nifti", data=header, shape=shape, **opt)
+        multiscales[0]["coordinateTransformations"] = [
+            {"scale": [1.0] * (3 + has_channel), "type": "scale"}
+        ]
+        omz.attrs["multiscales"] = multiscales
+
+        # Write NIfTI-Zarr header
+        # NOTE: we use nifti2 because dimensions typically do not fit in a short
+        # TODO: we do not write the json zattrs, but it should be added in
+        #       once the nifti-zarr package is released
+        shape = list(reversed(arrays[0].shape))
+        if has_channel:
+            shape = shape[:3] + [1] + shape[3:]
+        affine = orientation_to_affine(orientation, vxw, vxh, thickness or 1)
+        if center:
+            affine = center_affine(affine, shape[:2])
+        header = nib.Nifti2Header()
+        header.set_data_shape(shape)
+        header.set_data_dtype(arrays[0].dtype)
+        header.set_qform(affine)
+        header.set_sform(affine)
+        header.set_xyzt_units(nib.nifti1.unit_codes.code["micron"])
+        header.structarr["magic"] = b"n+2\0"
+        header = header.structarr.reshape(1).view("u1")
+        opt = {
+            "chunks": [len(header)],
+            "dimension_separator": r"/",
+            "order": "F",
+            "dtype": "|u1",
+            "fill_value": None,
+            "compressor": None,
+        }
+        omz.create_dataset("nifti", data=header, shape=(len(header),), **opt)
+
+        # Gather all group/array metadata into a single `.zmetadata` object
+        # so that readers (`zarr.open_consolidated`) need only one request.
+        zarr.consolidate_metadata(omz.store)
+
+        if remote:
+            print("Upload to", out)
+            fs, path = fsspec.core.url_to_fs(out)
+            fs.put(store_path + "/", path, recursive=True)
+    finally:
+        # (the local copy is removed even if conversion or upload fails)
+        if remote:
+            staging.cleanup()
 
     # Write sidecar .json file
     json_name = os.path.splitext(out)[0]
@@ -301,7 +445,7 @@ def convert(
     dic["SliceThicknessUnits"] = "mm"
     dic["SampleStaining"] = "LY"
 
-    with open(json_name, "w") as outfile:
+    with fsspec.open(json_name, "w") as outfile:
         json.dump(dic, outfile)
         outfile.write("\n")
 
@@ -8,6 +8,7 @@ It does not recompute the image pyramid but instead reuse the JPEG2000 levels
 # stdlib
 import ast
 import os
+import time
 
 # externals
 import glymur
@@ -122,16 +123,19 @@ def convert(
         subdat = WrappedJ2K(j2k, level=level)
         shape = subdat.shape
         print("Convert level", level, "with shape", shape)
-        omz.create_dataset(str(level), shape=shape, **opt)
-        array = omz[str(level)]
+        array = omz.create_dataset(str(level), shape=shape, **opt)
         if max_load is None or (shape[-2] < max_load and shape[-1] < max_load):
             array[...] = subdat[...]
         else:
             ni = ceildiv(shape[-2], max_load)
             nj = ceildiv(shape[-1], max_load)
+            last_print = 0.0
             for i in range(ni):
                 for j in range(nj):
-                    print(f"\r{i+1}/{ni}, {j+1}/{nj}", end="")
+                    now = time.monotonic()
+                    if now - last_print > 0.5:
+                        last_print = now
+                        print(f"\r{i+1}/{ni}, {j+1}/{nj}", end="")
                     array[
                         ...,
                         i * max_load : min((i + 1) * max_load, shape[-2]),
@@ -160,8 +164,8 @@ def convert(
     if has_channel:
         multiscales[0]["axes"].insert(0, {"name": "c", "type": "channel"})
 
+    shape0 = omz["0"].shape[-2:]
     for n in range(nblevel):
-        shape0 = omz["0"].shape[-2:]
         shape = omz[str(n)].shape[-2:]
         multiscales[0]["datasets"].append({})
         level = multiscales[0]["datasets"][-1]
@@ -215,7 +219,7 @@ def convert(
     header.set_sform(affine)
     header.set_xyzt_units(nib.nifti1.unit_codes.code["micron"])
     header.structarr["magic"] = b"n+2\0"
-    header = np.frombuffer(header.structarr.tobytes(), dtype="u1")
+    header = header.structarr.reshape(1).view("u1")
     opt = {
         "chunks": [len(header)],
         "dimension_separator": r"/",
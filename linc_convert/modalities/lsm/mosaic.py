@@ -9,6 +9,7 @@ https://lincbrain.org/dandiset/000004/0.240319.1924/files?location=derivatives%2
 import ast
 import os
 import re
+import time
 from glob import glob
 
 # externals
@@ -206,8 +207,7 @@ def convert(
     }
 
     # write first level
-    omz.create_dataset("0", shape=[nchannels, *fullshape], **opt)
-    array = omz["0"]
+    array = omz.create_dataset("0", shape=[nchannels, *fullshape], **opt)
     print("Write level 0 with shape", [nchannels, *fullshape])
     for i, dirname in enumerate(all_chunks_info["dirname"]):
         chunkz = all_chunks_info["z"][i] - 1
@@ -239,9 +239,11 @@ def convert(
     print("")
 
     # build pyramid using median windows
+    # (array handles are carried across levels rather than looked up
+    #  again in the group, which re-reads their metadata)
     level = 0
-    while any(x > 1 for x in omz[str(level)].shape[-3:]):
-        prev_array = omz[str(level)]
+    prev_array = array
+    while any(x > 1 for x in prev_array.shape[-3:]):
         prev_shape = prev_array.shape[-3:]
         level += 1
 
@@ -249,18 +251,24 @@ def convert(
         if all(x < chunk for x in new_shape):
             break
         print("Compute level", level, "with shape", new_shape)
-        omz.create_dataset(str(level), shape=[nchannels, *new_shape], **opt)
-        new_array = omz[str(level)]
+        new_array = omz.create_dataset(str(level), shape=[nchannels, *new_shape], **opt)
 
         nz, ny, nx = prev_array.shape[-3:]
         ncz = ceildiv(nz, max_load)
         ncy = ceildiv(ny, max_load)
         ncx = ceildiv(nx, max_load)
 
+        last_print = 0.0
         for cz in range(ncz):
             for cy in range(ncy):
                 for cx in range(ncx):
-                    print(f"chunk ({cz}, {cy}, {cx}) / ({ncz}, {ncy}, {ncx})", end="\r")
+                    now = time.monotonic()
+                    if now - last_print > 0.5:
+                        last_print = now
+                        print(
+                            f"chunk ({cz}, {cy}, {cx}) / ({ncz}, {ncy}, {ncx})",
+                            end="\r",
+                        )
 
                     dat = prev_array[
                         ...,
@@ -302,6 +310,7 @@ def convert(
                         cy * max_load // 2 : (cy + 1) * max_load // 2,
                         cx * max_load // 2 : (cx + 1) * max_load // 2,
                     ] = dat
+        prev_array = new_array
 
     print("")
     nblevel = level
@@ -325,8 +334,8 @@ def convert(
 
     voxel_size = list(map(float, reversed(voxel_size)))
     factor = [1] * 3
-    for n in range(nblevel):
-        shape = omz[str(n)].shape[-3:]
+    shapes = [omz[str(n)].shape[-3:] for n in range(nblevel)]
+    for n, shape in enumerate(shapes):
         multiscales[0]["datasets"].append({})
         level = multiscales[0]["datasets"][-1]
         level["path"] = str(n)
@@ -334,7 +343,7 @@ def convert(
         # We made sure that the downsampling level is exactly 2
         # However, once a dimension has size 1, we stop downsampling.
         if n > 0:
-            shape_prev = omz[str(n - 1)].shape[-3:]
+            shape_prev = shapes[n - 1]
             if shape_prev[0] != shape[0]:
                 factor[0] *= 2
             if shape_prev[1] != shape[1]:
@@ -387,7 +396,7 @@ def convert(
     header.set_sform(affine)
     header.set_xyzt_units(nib.nifti1.unit_codes.code["micron"])
     header.structarr["magic"] = b"nz2\0"
-    header = np.frombuffer(header.structarr.tobytes(), dtype="u1")
+    header = header.structarr.reshape(1).view("u1")
     opt = {
         "chunks": [len(header)],
         "dimension_separator": r"/",
@@ -1,13 +1,180 @@
 import itertools
+import json
+import math
+import os
 import re
-from typing import Any, Literal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Literal
+from warnings import warn
 
 import nibabel as nib
+import numcodecs
 import numpy as np
 import zarr
 
 from linc_convert.utils.math import ceildiv
-from linc_convert.utils.unit import convert_unit
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Patterns for "<value><unit>", "<value>x<value><unit>", etc.
+_NUMBER = r"-?(\d+\.?\d*|\d*\.?\d+)(E-?\d+)?"
+_VALUE_UNIT = {
+    n: re.compile(r"(?P<value>" + "x".join([_NUMBER] * n) + r")(?P<unit>\w*)")
+    for n in (1, 2, 3)
+}
+# Pattern for "<key>: <value>" lines
+_KEY_VALUE = re.compile(
+    r"^[^\S\n]*([^:\n]*?)[^\S\n]*:[^\S\n]*(.*?)[^\S\n]*$", re.MULTILINE
+)
+
+
+def _parse_value_unit(string: str, n: int = 1) -> tuple[float | list[float], str]:
+    """Parse "<value><unit>" (n == 1) or "<value>x<value>...<unit>"."""
+    match = _VALUE_UNIT[n].fullmatch(string)
+    value, unit = match.group("value"), match.group("unit")
+    value = list(map(float, value.split("x")))
+    if n == 1:
+        value = value[0]
+    return value, unit
+
+
+def _value_unit_handler(
+    field: str, unit_field: str | None, n: int, cast: type
+) -> Callable[[str, dict], None]:
+    """Build a handler that stores a "<value><unit>" entry (and its unit)."""
+
+    def handler(value: str, meta: dict) -> None:
+        value, unit = _parse_value_unit(value, n)
+        meta[field] = cast(value)
+        if unit_field:
+            meta[unit_field] = unit
+
+    return handler
+
+
+def _medium_handler(value: str, meta: dict) -> None:
+    parts = value.split()
+    if "TDE" in parts:
+        parts[parts.index("TDE")] = "2,2' Thiodiethanol (TDE)"
+    meta["SampleMedium"] = " ".join(parts)
+
+
+def _modality_handler(value: str, meta: dict) -> None:
+    meta["OCTModality"] = value
+
+
+# OCT metadata key -> handler that stores its value in the JSON dict
+_META_HANDLERS: dict[str, Callable[[str, dict], None]] = {
+    "Image medium": _medium_handler,
+    "Center Wavelength": _value_unit_handler(
+        "Wavelength", "WavelengthUnit", 1, float
+    ),
+    "Axial resolution": _value_unit_handler(
+        "ResolutionAxial", "ResolutionAxialUnit", 1, float
+    ),
+    "Lateral resolution": _value_unit_handler(
+        "ResolutionLateral", "ResolutionLateralUnit", 1, float
+    ),
+    "Voxel size": _value_unit_handler("PixelSize", "PixelSizeUnits", 3, list),
+    "Depth focus range": _value_unit_handler(
+        "DepthFocusRange", "DepthFocusRangeUnit", 1, float
+    ),
+    "Number of focuses": _value_unit_handler("FocusCount", None, 1, int),
+    "Slice thickness": _value_unit_handler("SliceThickness", None, 1, float),
+    "Number of slices": _value_unit_handler("SliceCount", None, 1, int),
+    "Modality": _modality_handler,
+}
+
+# The compiled kernels are serial and release the GIL: blocks are
+# already pooled in parallel by thread pools, from which numba's own
+# threading layers must not be used.
+if numba is not None:
+
+    def _make_pool_mean(wi: int, wj: int, wk: int) -> Callable:
+        """
+        Compile a mean over `wi x wj x wk` windows (sizes 1 or 2).
+
+        The window sizes are frozen into the kernel, so that its index
+        arithmetic is constant-folded. The 8 corners of each window are
+        always summed (some of them twice along axes of size 1), which
+        averages the same values and keeps the inner loop branch-free.
+        """
+
+        @numba.njit(nogil=True, cache=True)
+        def pool_mean(dat: np.ndarray, out: np.ndarray) -> None:
+            for i in range(out.shape[0]):
+                i0 = wi * i
+                i1 = i0 + wi - 1
+                for j in range(out.shape[1]):
+                    j0 = wj * j
+                    j1 = j0 + wj - 1
+                    for k in range(out.shape[2]):
+                        k0 = wk * k
+                        k1 = k0 + wk - 1
+                        acc = 0.0
+                        acc += dat[i0, j0, k0]
+                        acc += dat[i0, j0, k1]
+                        acc += dat[i0, j1, k0]
+                        acc += dat[i0, j1, k1]
+                        acc += dat[i1, j0, k0]
+                        acc += dat[i1, j0, k1]
+                        acc += dat[i1, j1, k0]
+                        acc += dat[i1, j1, k1]
+                        out[i, j, k] = acc / 8
+
+        return pool_mean
+
+    # Axis that is not pooled (`no_pyramid_axis`) -> specialized kernel
+    _POOL_MEAN = {
+        axis: _make_pool_mean(*[1 if a == axis else 2 for a in range(3)])
+        for axis in (None, 0, 1, 2)
+    }
+
+
+def compressor_defaults(
+    compressor: str, opt: dict, dtype: np.dtype | str
+) -> tuple[str, dict]:
+    """
+    Fill in the default options of the compressor used for OCT data.
+
+    Blosc defaults to zstd (level 3) with bit shuffling, which compresses
+    OCT volumes about as well as byte shuffling, at 2-3x the speed.
+    ZFP defaults to its (lossy) fixed-rate mode, at 8 bits per value;
+    it only handles floating point data, so Blosc is used instead for
+    other data types. Options that are explicitly set are kept.
+    """
+    opt = dict(opt)
+    if isinstance(compressor, str) and compressor.lower() == "zfp":
+        if np.dtype(dtype).kind == "f":
+            opt.setdefault("mode", "fixed_rate")
+            opt.setdefault("rate", 8)
+            return compressor, opt
+        warn(f"ZFP does not support {np.dtype(dtype)} data, using Blosc instead")
+        compressor, opt = "blosc", {}
+    if isinstance(compressor, str) and compressor.lower() == "blosc":
+        opt.setdefault("cname", "zstd")
+        opt.setdefault("clevel", 3)
+        opt.setdefault("shuffle", numcodecs.Blosc.BITSHUFFLE)
+    return compressor, opt
+
+
+def write_json(obj: dict, path: str) -> None:
+    """Write a JSON file, using orjson when available."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(obj, indent=2, ensure_ascii=False))
 
 
 def make_json(oct_meta: str) -> dict:
@@ -25,147 +192,229 @@ def make_json(oct_meta: str) -> dict:
     Depth focus range: 225um
     Number of focuses: 2
     Focus #: 2
-    Slice thickness: 450um.
+    Slice thickness: 450um
     Number of slices: 75
     Slice #:23
     Modality: dBI
     """
-
-    def _parse_value_unit(
-        string: str, n: int = None
-    ) -> tuple[float | list[float], str | Any]:
-        number = r"-?(\d+\.?\d*|\d*\.?\d+)(E-?\d+)?"
-        value = "x".join([number] * (n or 1))
-        match = re.fullmatch(r"(?P<value>" + value + r")(?P<unit>\w*)", string)
-        value, unit = match.group("value"), match.group("unit")
-        value = list(map(float, value.split("x")))
-        if n is None:
-            value = value[0]
-        return value, unit
-
     meta = {
         "BodyPart": "BRAIN",
         "Environment": "exvivo",
         "SampleStaining": "none",
     }
 
-    for line in oct_meta.split("\n"):
-        if ":" not in line:
-            continue
-
-        key, value = line.split(":")
-        key, value = key.strip(), value.strip()
-
-        if key == "Image medium":
-            parts = value.split()
-            if "TDE" in parts:
-                parts[parts.index("TDE")] = "2,2' Thiodiethanol (TDE)"
-            meta["SampleMedium"] = " ".join(parts)
-
-        elif key == "Center Wavelength":
-            value, unit = _parse_value_unit(value)
-            meta["Wavelength"] = value
-            meta["WavelengthUnit"] = unit
+    for key, value in _KEY_VALUE.findall(oct_meta):
+        handler = _META_HANDLERS.get(key)
+        if handler is not None:
+            handler(value, meta)
 
-        elif key == "Axial resolution":
-            value, unit = _parse_value_unit(value)
-            meta["ResolutionAxial"] = value
-            meta["ResolutionAxialUnit"] = unit
-
-        elif key == "Lateral resolution":
-            value, unit = _parse_value_unit(value)
-            meta["ResolutionLateral"] = value
-            meta["ResolutionLateralUnit"] = unit
-
-        elif key == "Voxel size":
-            value, unit = _parse_value_unit(value, n=3)
-            meta["PixelSize"] = value
-            meta["PixelSizeUnits"] = unit
-
-        elif key == "Depth focus range":
-            value, unit = _parse_value_unit(value)
-            meta["DepthFocusRange"] = value
-            meta["DepthFocusRangeUnit"] = unit
+    return meta
 
-        elif key == "Number of focuses":
-            value, unit = _parse_value_unit(value)
-            meta["FocusCount"] = int(value)
 
-        elif key == "Slice thickness":
-            value, unit = _parse_value_unit(value)
-            unit = convert_unit(value, unit[:-1], "u")
-            meta["SliceThickness"] = value
+def _median(dat: np.ndarray, overwrite_input: bool = False) -> np.ndarray:
+    """
+    Median along the last axis, by partial sorting.
 
-        elif key == "Number of slices":
-            value, unit = _parse_value_unit(value)
-            meta["SliceCount"] = int(value)
+    If `overwrite_input`, `dat` is partitioned in place (as in
+    `np.median`) instead of being copied first.
+    """
+    n = dat.shape[-1]
+    k = n // 2
+    kth = k if n % 2 else (k - 1, k)
+    if overwrite_input:
+        dat.partition(kth, axis=-1)
+    else:
+        dat = np.partition(dat, kth, axis=-1)
+    if n % 2:
+        return dat[..., k]
+    lo, hi = dat[..., k - 1], dat[..., k]
+    if np.issubdtype(dat.dtype, np.integer):
+        # Exact integer average, rounded towards zero like `astype`
+        total = lo.astype(np.int64) + hi
+        return (total + (total < 0)) // 2
+    return (lo + hi) / 2
+
+
+def _downsample(
+    dat: np.ndarray,
+    fullshape: list[int],
+    ndim: int = 3,
+    mode: Literal["mean", "median"] = "median",
+    no_pyramid_axis: int | None = None,
+) -> np.ndarray | None:
+    """
+    Downsample a block of data by a factor two.
 
-        elif key == "Modality":
-            meta["OCTModality"] = value
+    Parameters
+    ----------
+    dat : np.ndarray
+        Block of data, with shape `(*batch, *spatial)`.
+    fullshape : list[int]
+        Spatial shape of the full array the block belongs to.
+    ndim : int
+        Number of spatial dimensions.
+    mode : {"mean", "median"}
+        Whether to use a mean or median moving window.
+    no_pyramid_axis : int | None
+        Spatial axis that is not downsampled.
 
+    Returns
+    -------
+    dat : np.ndarray | None
+        Downsampled block, or `None` if the block is empty once its
+        odd dimensions are cropped.
+    """
+    batch = list(dat.shape[:-ndim])
+
+    # Discard the last voxel along odd dimensions
+    crop = [0 if y == 1 else x % 2 for x, y in zip(dat.shape[-ndim:], fullshape)]
+    # Don't crop the axis not down-sampling
+    # cannot do if not no_pyramid_axis since it could be 0
+    if no_pyramid_axis is not None:
+        crop[no_pyramid_axis] = 0
+    slcr = [slice(-1) if x else slice(None) for x in crop]
+    # (the cropped block is kept as a view: the pooling paths below read
+    #  each voxel once, so a contiguous copy would only add a pass)
+    dat = dat[tuple([Ellipsis, *slcr])]
+
+    if any(n == 0 for n in dat.shape):
+        # last strip had a single voxel, nothing to do
+        return None
+
+    patch_shape = dat.shape[-ndim:]
+
+    if (
+        numba is not None
+        and mode == "mean"
+        and ndim == 3
+        and not batch
+        and (
+            np.issubdtype(dat.dtype, np.integer)
+            or np.issubdtype(dat.dtype, np.floating)
+        )
+        and dat.dtype.isnative
+        and all(n >= 2 for i, n in enumerate(patch_shape) if i != no_pyramid_axis)
+    ):
+        # Compiled mean, without temporaries
+        # (2x2 windows across `no_pyramid_axis`, if any)
+        window = [1 if axis == no_pyramid_axis else 2 for axis in range(ndim)]
+        out = np.empty([n // w for n, w in zip(patch_shape, window)], dat.dtype)
+        _POOL_MEAN[no_pyramid_axis](dat, out)
+        return out
+
+    if mode == "mean":
+        # Sum the strided corners of each window, which only allocates
+        # an output-sized accumulator (no reshape/transpose copies)
+        offsets, steps = [], []
+        for axis, n in enumerate(patch_shape):
+            pooled = axis != no_pyramid_axis
+            offsets.append((0, 1) if pooled and n >= 2 else (0,))
+            steps.append(2 if pooled else 1)
+        if np.issubdtype(dat.dtype, np.integer):
+            # twice as wide as the data, which holds the sum of 8 values
+            itemsize = min(2 * dat.dtype.itemsize, 8)
+            acc_dtype = np.dtype(f"{dat.dtype.kind}{itemsize}")
         else:
-            continue
-
-    return meta
-
-
-def generate_pyramid(
+            acc_dtype = np.promote_types(dat.dtype, np.float32)
+        total, count = None, 0
+        for offset in itertools.product(*offsets):
+            corner = dat[(Ellipsis, *map(slice, offset, [None] * ndim, steps))]
+            if total is None:
+                total = corner.astype(acc_dtype)
+            else:
+                total += corner
+            count += 1
+        # Divide in place when the quotient keeps the accumulator type
+        # (for unsigned integers, flooring is rounding towards zero, and
+        #  `count` is a power of two)
+        if np.issubdtype(dat.dtype, np.unsignedinteger):
+            total >>= count.bit_length() - 1
+        elif np.issubdtype(dat.dtype, np.signedinteger):
+            total = total / count
+        else:
+            # (multiplying by 1/2**n is exact, and cheaper than dividing)
+            total *= 1 / count
+        return total.astype(dat.dtype, copy=False)
+
+    # View the block as patches of shape 2x2x2, with the window axes
+    # last (zero-copy, whatever the layout of the cropped block)
+    windows = [
+        1 if axis == no_pyramid_axis or n < 2 else 2
+        for axis, n in enumerate(patch_shape)
+    ]
+    smaller_shape = [n // w for n, w in zip(patch_shape, windows)]
+    strides = dat.strides[-ndim:]
+    dat = np.lib.stride_tricks.as_strided(
+        dat,
+        shape=batch + smaller_shape + windows,
+        strides=(
+            dat.strides[: len(batch)]
+            + tuple(s * w for s, w in zip(strides, windows))
+            + strides
+        ),
+        writeable=False,
+    )
+
+    # -> flatten patches
+    # (this gathers them into a fresh buffer, which can then be
+    #  partitioned in place)
+    block = dat
+    dat = dat.reshape(batch + smaller_shape + [-1])
+    if np.may_share_memory(dat, block):
+        dat = dat.copy()
+
+    # Compute the median of each patch
+    dtype = dat.dtype
+    dat = _median(dat, overwrite_input=True)
+    dat = dat.astype(dtype)
+    return dat
+
+
+def _create_levels(
     omz: zarr.Group,
     levels: int | None = None,
     ndim: int = 3,
-    max_load: int = 512,
-    mode: Literal["mean", "median"] = "median",
-    no_pyramid_axis: int | str | None = None,
+    no_pyramid_axis: int | None = None,
+    compressed: bool = True,
 ) -> list[list[int]]:
     """
-    Generate the levels of a pyramid in an existing Zarr.
+    Create the (empty) levels of a pyramid in an existing Zarr.
 
     Parameters
     ----------
-    path : PathLike | str
-        Path to parent Zarr
+    omz : zarr.Group
+        Parent Zarr, that already contains the base level.
     levels : int
-        Number of additional levels to generate.
+        Number of additional levels to create.
         By default, stop when all dimensions are smaller than their
         corresponding chunk size.
-    shard : list[int] | bool | {"auto"} | None
-        Shard size.
-        * If `None`, use same shard size as the input array;
-        * If `False`, no dot use sharding;
-        * If `True` or `"auto"`, automatically find shard size;
-        * Otherwise, use provided shard size.
     ndim : int
         Number of spatial dimensions.
-    max_load : int
-        Maximum number of voxels to load along each dimension.
-    mode : {"mean", "median"}
-        Whether to use a mean or median moving window.
+    no_pyramid_axis : int | None
+        Spatial axis that is not downsampled.
+    compressed : bool
+        Use the compressor of the base level. Otherwise, the new levels
+        are written uncompressed.
 
     Returns
     -------
     shapes : list[list[int]]
-        Shapes of all levels, from finest to coarsest, including the
-        existing top level.
+        Spatial shapes of all levels, from finest to coarsest, including
+        the existing top level.
     """
     # Read properties from base level
-    shape = list(omz["0"].shape)
-    chunk_size = omz["0"].chunks
+    base = omz["0"]
+    shape = list(base.shape)
+    chunk_size = base.chunks
     opt = {
-        "dimension_separator": omz["0"]._dimension_separator,
-        "order": omz["0"]._order,
-        "dtype": omz["0"]._dtype,
-        "fill_value": omz["0"]._fill_value,
-        "compressor": omz["0"]._compressor,
-        "chunks": omz["0"].chunks,
+        "dimension_separator": base._dimension_separator,
+        "order": base._order,
+        "dtype": base._dtype,
+        "fill_value": base._fill_value,
+        "compressor": base._compressor if compressed else None,
+        "chunks": base.chunks,
     }
 
-    # Select windowing function
-    if mode == "median":
-        func = np.median
-    else:
-        assert mode == "mean"
-        func = np.mean
-
     level = 0
     batch, shape = shape[:-ndim], shape[-ndim:]
     allshapes = [shape]
@@ -188,85 +437,292 @@ def generate_pyramid(
         elif level > levels:
             break
 
-        print("Compute level", level, "with shape", shape)
+        print("Create level", level, "with shape", shape)
 
         allshapes.append(shape)
         omz.create_dataset(str(level), shape=batch + shape, **opt)
 
-        # Iterate across `max_load` chunks
-        # (note that these are unrelared to underlying zarr chunks)
-        grid_shape = [ceildiv(n, max_load) for n in prev_shape]
-        for chunk_index in itertools.product(*[range(x) for x in grid_shape]):
-            print(f"chunk {chunk_index} / {tuple(grid_shape)})", end="\r")
+    return allshapes
+
+
+def _write_pyramid_block(
+    arrays: list[zarr.Array],
+    dat: np.ndarray,
+    chunk_index: tuple[int, ...],
+    max_load: int,
+    allshapes: list[list[int]],
+    ndim: int = 3,
+    mode: Literal["mean", "median"] = "median",
+    no_pyramid_axis: int | None = None,
+) -> None:
+    """
+    Compute and write all coarser levels of a block of the base level.
+
+    Parameters
+    ----------
+    arrays : list[zarr.Array]
+        All levels of the pyramid, from finest to coarsest.
+    dat : np.ndarray
+        Block of the base level.
+    chunk_index : tuple[int]
+        Index of the block in the grid of `max_load` blocks.
+    max_load : int
+        Block size. Must be a multiple of `2**(len(arrays) - 1)`.
+    allshapes : list[list[int]]
+        Spatial shapes of all levels.
+    ndim : int
+        Number of spatial dimensions.
+    mode : {"mean", "median"}
+        Whether to use a mean or median moving window.
+    no_pyramid_axis : int | None
+        Spatial axis that is not downsampled.
+    """
+    for level in range(1, len(arrays)):
+        dat = _downsample(dat, allshapes[level - 1], ndim, mode, no_pyramid_axis)
+        if dat is None:
+            break
+
+        slicer = [Ellipsis]
+        for axis_index, i in enumerate(chunk_index):
+            if axis_index == no_pyramid_axis:
+                start = i * max_load
+            else:
+                start = i * max_load // 2**level
+            slicer.append(slice(start, start + dat.shape[axis_index - ndim]))
+
+        arrays[level].set_basic_selection(tuple(slicer), dat)
+
+
+def _inline_levels(
+    max_load: int,
+    chunk_size: list[int],
+    grid_shape: list[int],
+    levels: int,
+    no_pyramid_axis: int | None = None,
+) -> int:
+    """
+    Count the levels that can be computed from blocks of the base level.
+
+    A level qualifies if, along each axis split into several blocks, its
+    part of a block is a whole number of chunks, so that no two blocks
+    write into the same chunk (and no chunk is read back and rewritten).
+    """
+    nbinline = 0
+    while nbinline < levels:
+        factor = 2 ** (nbinline + 1)
+        if any(
+            max_load % (chunk * factor)
+            for axis, (chunk, grid) in enumerate(zip(chunk_size, grid_shape))
+            if axis != no_pyramid_axis and grid > 1
+        ):
+            break
+        nbinline += 1
+    return nbinline
+
+
+def _stream_levels(
+    executor: ThreadPoolExecutor,
+    arrays: list[zarr.Array],
+    allshapes: list[list[int]],
+    first_level: int,
+    ndim: int = 3,
+    mode: Literal["mean", "median"] = "median",
+    no_pyramid_axis: int | None = None,
+) -> None:
+    """
+    Compute levels of a pyramid, chunk by chunk, from the level above.
 
-            # Read one chunk of data at the previous resolution
-            slicer = [Ellipsis] + [
-                slice(i * max_load, min((i + 1) * max_load, n))
-                for i, n in zip(chunk_index, prev_shape)
-            ]
-            fullshape = omz[str(level - 1)].shape
-            dat = omz[str(level - 1)][tuple(slicer)]
-
-            # Discard the last voxel along odd dimensions
-            crop = [
-                0 if y == 1 else x % 2 for x, y in zip(dat.shape[-ndim:], fullshape)
-            ]
-            # Don't crop the axis not down-sampling
-            # cannot do if not no_pyramid_axis since it could be 0
-            if no_pyramid_axis is not None:
-                crop[no_pyramid_axis] = 0
-            slcr = [slice(-1) if x else slice(None) for x in crop]
-            dat = dat[tuple([Ellipsis, *slcr])]
-
-            if any(n == 0 for n in dat.shape):
-                # last strip had a single voxel, nothing to do
-                continue
-
-            patch_shape = dat.shape[-ndim:]
-
-            # Reshape into patches of shape 2x2x2
-            windowed_shape = [
-                x for n in patch_shape for x in (max(n // 2, 1), min(n, 2))
-            ]
-            if no_pyramid_axis is not None:
-                windowed_shape[2 * no_pyramid_axis] = patch_shape[no_pyramid_axis]
-                windowed_shape[2 * no_pyramid_axis + 1] = 1
-
-            dat = dat.reshape(batch + windowed_shape)
-            # -> last `ndim`` dimensions have shape 2x2x2
-            dat = dat.transpose(
-                list(range(len(batch)))
-                + list(range(len(batch), len(batch) + 2 * ndim, 2))
-                + list(range(len(batch) + 1, len(batch) + 2 * ndim, 2))
+    Parameters
+    ----------
+    executor : ThreadPoolExecutor
+        Executor in which chunks of a level are processed.
+    arrays : list[zarr.Array]
+        All levels of the pyramid, from finest to coarsest.
+    allshapes : list[list[int]]
+        Spatial shapes of all levels.
+    first_level : int
+        First level to compute. All levels above it must be written.
+    ndim : int
+        Number of spatial dimensions.
+    mode : {"mean", "median"}
+        Whether to use a mean or median moving window.
+    no_pyramid_axis : int | None
+        Spatial axis that is not downsampled.
+    """
+    for level in range(first_level, len(arrays)):
+        print("Stream level", level, end="\r")
+        src, dst = arrays[level - 1], arrays[level]
+        chunk_size = dst.chunks[-ndim:]
+        factors = [1 if axis == no_pyramid_axis else 2 for axis in range(ndim)]
+
+        def process_chunk(chunk_index: tuple[int, ...]) -> None:
+            # Read the region of the level above that pools into this
+            # chunk, and write the chunk whole
+            src_slicer, dst_slicer = [Ellipsis], [Ellipsis]
+            for i, c, f, n in zip(chunk_index, chunk_size, factors, allshapes[level]):
+                src_slicer.append(slice(i * c * f, (i + 1) * c * f))
+                dst_slicer.append(slice(i * c, min((i + 1) * c, n)))
+            dat = src.get_basic_selection(tuple(src_slicer))
+            dat = _downsample(dat, allshapes[level - 1], ndim, mode, no_pyramid_axis)
+            dst.set_basic_selection(tuple(dst_slicer), dat)
+
+        grid_shape = [ceildiv(n, c) for n, c in zip(allshapes[level], chunk_size)]
+        if all(x == 1 for x in grid_shape):
+            # This level and all coarser ones fit in a single chunk: pool
+            # them in memory from one read of the level above, rather than
+            # writing each of them and reading it back
+            dat = src.get_basic_selection(Ellipsis)
+            for top_level in range(level, len(arrays)):
+                dat = _downsample(
+                    dat, allshapes[top_level - 1], ndim, mode, no_pyramid_axis
+                )
+                arrays[top_level].set_basic_selection(Ellipsis, dat)
+            break
+
+        # (levels are computed one after the other)
+        list(
+            executor.map(
+                process_chunk, itertools.product(*[range(x) for x in grid_shape])
             )
-            # -> flatten patches
-            smaller_shape = [max(n // 2, 1) for n in patch_shape]
-            if no_pyramid_axis is not None:
-                smaller_shape[no_pyramid_axis] = patch_shape[no_pyramid_axis]
+        )
 
-            dat = dat.reshape(batch + smaller_shape + [-1])
 
-            # Compute the median/mean of each patch
-            dtype = dat.dtype
-            dat = func(dat, axis=-1)
-            dat = dat.astype(dtype)
+def generate_pyramid(
+    omz: zarr.Group,
+    levels: int | None = None,
+    ndim: int = 3,
+    max_load: int = 512,
+    mode: Literal["mean", "median"] = "median",
+    no_pyramid_axis: int | None = None,
+    max_workers: int | None = None,
+    compressed: bool = True,
+) -> list[list[int]]:
+    """
+    Generate the levels of a pyramid in an existing Zarr.
 
-            # Write output
-            slicer = [Ellipsis] + [
-                slice(i * max_load // 2, min((i + 1) * max_load // 2, n))
-                if axis_index != no_pyramid_axis
-                else slice(i * max_load, min((i + 1) * max_load, n))
-                for i, axis_index, n in zip(chunk_index, range(ndim), shape)
-            ]
+    The base level is read once, by blocks. The finest levels of a block
+    are computed in memory from it, as long as they cover whole chunks;
+    coarser levels are then computed, chunk by chunk, from the level
+    above them.
 
-            omz[str(level)][tuple(slicer)] = dat
+    Parameters
+    ----------
+    omz : zarr.Group
+        Parent Zarr group, whose level "0" is the base level.
+    levels : int
+        Number of additional levels to generate.
+        By default, stop when all dimensions are smaller than their
+        corresponding chunk size.
+    ndim : int
+        Number of spatial dimensions.
+    max_load : int
+        Maximum number of voxels to load along each dimension
+        (rounded up to a multiple of `2**levels` and of the chunk size).
+    mode : {"mean", "median"}
+        Whether to use a mean or median moving window.
+    no_pyramid_axis : int | None
+        Spatial axis that is not downsampled.
+    max_workers : int | None
+        Number of blocks processed in parallel. Default: number of CPUs.
+    compressed : bool
+        Use the compressor of the base level. Otherwise, the new levels
+        are written uncompressed.
+
+    Returns
+    -------
+    shapes : list[list[int]]
+        Shapes of all levels, from finest to coarsest, including the
+        existing top level.
+    """
+    if mode not in ("mean", "median"):
+        raise ValueError(f"Unknown mode: {mode}")
+
+    allshapes = _create_levels(omz, levels, ndim, no_pyramid_axis, compressed)
+
+    nblevels = len(allshapes) - 1
+
+    # Array handles are opened once, outside of the loop over blocks
+    synchronizer = omz.synchronizer or zarr.ThreadSynchronizer()
+    arrays = [
+        zarr.open_array(
+            omz.store,
+            mode="r+",
+            path=omz[str(level)].path,
+            synchronizer=synchronizer,
+            write_empty_chunks=False,
+        )
+        for level in range(nblevels + 1)
+    ]
+
+    # Blocks are a multiple of 2**levels so that, at every level, they
+    # start on an even voxel and pool the same pairs as the full array.
+    # They are also a multiple of the base chunks that partition an
+    # axis, so that base chunks are never read twice. (Chunks that span
+    # a whole axis are left out: they would inflate blocks up to the
+    # full volume, e.g. lcm(128, 100) along a 100-slice axis.)
+    chunk_size = arrays[0].chunks[-ndim:]
+    step = math.lcm(
+        2**nblevels, *[c for c, n in zip(chunk_size, allshapes[0]) if c < n]
+    )
+    max_load = ceildiv(max_load, step) * step
+
+    # Iterate across `max_load` chunks of the base level
+    # (note that these are unrelared to underlying zarr chunks)
+    grid_shape = [ceildiv(n, max_load) for n in allshapes[0]]
+
+    # Levels whose chunks are covered by whole blocks are computed from
+    # the blocks while they are in memory; coarser levels are streamed
+    # from the level above them.
+    nbinline = _inline_levels(
+        max_load, chunk_size, grid_shape, nblevels, no_pyramid_axis
+    )
+
+    # progress is printed at most every half second
+    last_print = 0.0
+
+    def process_chunk(chunk_index: tuple[int, ...]) -> None:
+        nonlocal last_print
+        now = time.monotonic()
+        if now - last_print > 0.5:
+            last_print = now
+            print(f"chunk {chunk_index} / {tuple(grid_shape)})", end="\r")
+
+        # Read one chunk of data at the base resolution
+        slicer = [Ellipsis] + [
+            slice(i * max_load, min((i + 1) * max_load, n))
+            for i, n in zip(chunk_index, allshapes[0])
+        ]
+        dat = arrays[0].get_basic_selection(tuple(slicer))
+
+        # Compute and write the inline levels of this chunk
+        _write_pyramid_block(
+            arrays[: nbinline + 1],
+            dat,
+            chunk_index,
+            max_load,
+            allshapes,
+            ndim,
+            mode,
+            no_pyramid_axis,
+        )
+
+    # Decompression, pooling and compression release the GIL
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        if nbinline:
+            list(
+                executor.map(
+                    process_chunk,
+                    itertools.product(*[range(x) for x in grid_shape]),
+                )
+            )
+        _stream_levels(
+            executor, arrays, allshapes, nbinline + 1, ndim, mode, no_pyramid_axis
+        )
 
     print("")
 
     return allshapes
 
-    pass
-
 
 def write_ome_metadata(
     omz: zarr.Group,
@@ -286,8 +742,8 @@ def write_ome_metadata(
 
     Parameters
     ----------
-    path : str | PathLike
-        Path to parent Zarr.
+    omz : zarr.Group
+        Parent Zarr, already open.
     axes : list[str]
         Name of each dimension, in Zarr order (t, c, z, y, x)
     space_scale : float | list[float]
@@ -311,19 +767,15 @@ def write_ome_metadata(
 
     """
     # Read shape at each pyramid level
+    # (the group is listed once, rather than once per level)
+    keys = set(omz.array_keys())
     shapes = []
-    level = 0
-    while True:
+    for level in itertools.count():
         if levels is not None and level > levels:
             break
-
-        if str(level) not in omz.keys():
-            levels = level
+        if str(level) not in keys:
             break
-        shapes += [
-            omz[str(level)].shape,
-        ]
-        level += 1
+        shapes.append(omz[str(level)].shape)
 
     axis_to_type = {
         "x": "space",
@@ -485,7 +937,7 @@ def niftizarr_write_header(
     header.set_sform(affine)
     if unit:
         header.set_xyzt_units(nib.nifti1.unit_codes.code[unit])
-    header = np.frombuffer(header.structarr.tobytes(), dtype="u1")
+    header = header.structarr.reshape(1).view("u1")
 
     metadata = {
         "chunks": [len(header)],
@@ -6,12 +6,12 @@ into a OME-ZARR pyramid.
 """
 
 import ast
-import json
-import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from itertools import product
-from typing import Callable, Mapping, Optional
+from typing import Callable, Literal, Mapping, Optional
 from warnings import warn
 
 import cyclopts
@@ -22,9 +22,11 @@ from scipy.io import loadmat
 
 from linc_convert import utils
 from linc_convert.modalities.psoct._utils import (
+    compressor_defaults,
     generate_pyramid,
     make_json,
     niftizarr_write_header,
+    write_json,
     write_ome_metadata,
 )
 from linc_convert.modalities.psoct.cli import psoct
@@ -176,6 +178,8 @@ def convert(
     orientation: str = "RAS",
     center: bool = True,
     dtype: str | None = None,
+    compress_levels: Literal["all", "base", "none"] = "all",
+    max_workers: Optional[int] = None,
         **kwargs
 ) -> None:
     """
@@ -199,7 +203,8 @@ def convert(
     meta
         Path to the metadata file
     max_load
-        Maximum input chunk size
+        Maximum input chunk size (rounded up to a multiple of the
+        chunk size)
     max_levels
         Maximum number of pyramid levels
     no_pool
@@ -210,6 +215,18 @@ def convert(
         Set RAS[0, 0, 0] at FOV center
     dtype
         Data type to write into
+    compressor : {blosc, zlib, zfp, raw}
+        Compression method (zfp: floating point data only)
+    compressor_opt
+        Compression options (Blosc defaults to zstd, level 3, with
+        bit shuffling; e.g. `{"shuffle": "shuffle"}` for byte shuffling.
+        ZFP defaults to `{"mode": "fixed_rate", "rate": 8}`)
+    compress_levels
+        Pyramid levels to compress: `"all"`, only the `"base"` level
+        (levels >= 1 are written uncompressed) or `"none"`.
+    max_workers
+        Number of input tiles (and pyramid blocks) processed in parallel
+        (default: number of CPUs)
     """
     zarr_config = utils.zarr.zarr_config.update(zarr_config, **kwargs)
 
@@ -221,6 +238,16 @@ def convert(
     if isinstance(compressor_opt, str):
         compressor_opt = ast.literal_eval(compressor_opt)
 
+    # Input chunks are aligned with output chunks, so that each output
+    # chunk is written whole (no read-modify-write)
+    if max_load % chunk:
+        aligned = ceildiv(max_load, chunk) * chunk
+        warn(
+            f"max_load ({max_load}) is not a multiple of the chunk size "
+            f"({chunk}), using {aligned} instead"
+        )
+        max_load = aligned
+
     # Write OME-Zarr multiscale metadata
     if meta:
         print("Write JSON")
@@ -228,8 +255,7 @@ def convert(
             meta_txt = f.read()
             meta_json = make_json(meta_txt)
         path_json = ".".join(out.split(".")[:-2]) + ".json"
-        with open(path_json, "w") as f:
-            json.dump(meta_json, f, indent=4)
+        write_json(meta_json, path_json)
         vx = meta_json["PixelSize"]
         unit = meta_json["PixelSizeUnits"]
     else:
@@ -237,8 +263,10 @@ def convert(
         unit = "um"
 
     # Prepare Zarr group
-    omz = zarr.storage.DirectoryStore(out)
-    omz = zarr.group(store=omz, overwrite=True)
+    # (tiles are written from several threads; FSStore hands all chunks
+    #  of a write to the filesystem in a single `setitems` batch)
+    omz = zarr.storage.FSStore(out)
+    omz = zarr.group(store=omz, overwrite=True, synchronizer=zarr.ThreadSynchronizer())
 
     # if not hasattr(inp[0], "dtype"):
     #     raise Exception("Input is not an array. This is likely unexpected")
@@ -248,11 +276,18 @@ def convert(
     dtype = dtype or np.dtype(inp[0].dtype).str
     opt = {
         "dimension_separator": r"/",
-        "order": "F",
+        "order": "C",  # match the (C-contiguous) input and pooled arrays
         "dtype": dtype,
-        "fill_value": None,
-        "compressor": make_compressor(compressor, **compressor_opt),
+        "fill_value": 0,
+        # do not store chunks that only contain background
+        "write_empty_chunks": False,
     }
+    if compress_levels == "none":
+        compressor = "raw"
+    compressor, compressor_opt = compressor_defaults(
+        compressor, compressor_opt, dtype
+    )
+    opt["compressor"] = make_compressor(compressor, **compressor_opt)
     inp: list = inp
     inp_shape = (*inp[0].shape, len(inp))
     inp_chunk = [min(x, max_load) for x in inp_shape[-3:]]
@@ -260,48 +295,92 @@ def convert(
     nj = ceildiv(inp_shape[-2], inp_chunk[1])
     ni = len(inp)
 
+    # Number of levels above the base one: (x - 1).bit_length() is
+    # ceil(log2(x)), the number of halvings that bring x down to one voxel
     nblevels = min(
-        [
-            int(math.ceil(math.log2(x)))
-            for i, x in enumerate(inp_shape[-3:])
-            if i != no_pool
-        ]
+        (x - 1).bit_length() for i, x in enumerate(inp_shape[-3:]) if i != no_pool
     )
-    nblevels = min(nblevels, int(math.ceil(math.log2(max_load))))
-    nblevels = min(nblevels, max_levels)
+    nblevels = max(0, min(nblevels, (max_load - 1).bit_length(), max_levels) - 1)
 
     opt["chunks"] = [min(x, chunk) for x in inp_shape]
 
-    omz.create_dataset(str(0), shape=inp_shape, **opt)
+    array = omz.create_dataset(str(0), shape=inp_shape, **opt)
 
-    # iterate across input chunks
-    for i in range(ni):
-        for j, k in product(range(nj), range(nk)):
-            loaded_chunk = inp[i][
-                ...,
-                k * inp_chunk[0] : (k + 1) * inp_chunk[0],
-                j * inp_chunk[1] : (j + 1) * inp_chunk[1],
-            ]
+    # Slices are written in groups that span whole chunks along the
+    # slice axis, so that each output chunk is written once rather than
+    # read, modified and rewritten for every slice it contains.
+    # Old-style .mat files are loaded whole, so they are still written
+    # one slice at a time, to only hold one slice in memory.
+    ichunk = opt["chunks"][-1]
+    if any(isinstance(x, _MatArrayWrapper) for x in inp):
+        ichunk = 1
+    ng = ceildiv(ni, ichunk)
+
+    # progress is printed at most every half second
+    progress_total = f"[{nk:03d}, {nj:03d}, {ng:03d}]"
+    last_print = 0.0
 
+    # iterate across input chunks
+    def process_tile(g: int, k: int, j: int) -> None:
+        nonlocal last_print
+        loaded_chunk = np.stack(
+            [
+                inp[i][
+                    ...,
+                    k * inp_chunk[0] : (k + 1) * inp_chunk[0],
+                    j * inp_chunk[1] : (j + 1) * inp_chunk[1],
+                ]
+                for i in range(g * ichunk, min((g + 1) * ichunk, ni))
+            ],
+            axis=-1,
+        )
+
+        now = time.monotonic()
+        if now - last_print > 0.5:
+            last_print = now
             print(
-                f"[{i + 1:03d}, {j + 1:03d}, {k + 1:03d}]",
+                f"[{k + 1:03d}, {j + 1:03d}, {g + 1:03d}]",
                 "/",
-                f"[{ni:03d}, {nj:03d}, {nk:03d}]",
-                # f"({1 + level}/{nblevels})",
+                progress_total,
                 end="\r",
             )
 
-            # save current chunk
-            omz["0"][
+        # save current chunk
+        # (plain slices: skip zarr's generic indexing dispatch)
+        array.set_basic_selection(
+            np.s_[
                 ...,
-                k * inp_chunk[-3] : k * inp_chunk[-3] + loaded_chunk.shape[-2],
-                j * inp_chunk[-2] : j * inp_chunk[-2] + loaded_chunk.shape[-1],
-                i,
-            ] = loaded_chunk
-
-        inp[i] = None  # no ref count -> delete array
+                k * inp_chunk[0] : k * inp_chunk[0] + loaded_chunk.shape[-3],
+                j * inp_chunk[1] : j * inp_chunk[1] + loaded_chunk.shape[-2],
+                g * ichunk : g * ichunk + loaded_chunk.shape[-1],
+            ],
+            loaded_chunk,
+        )
+
+    # Blosc releases the GIL, so compression of different tiles overlaps
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        for g in range(ng):
+            group = range(g * ichunk, min((g + 1) * ichunk, ni))
+            # old-style .mat files are loaded whole on first access:
+            # load the slice up front (rather than once per thread)
+            for i in group:
+                len(inp[i])
+            list(
+                executor.map(
+                    lambda kj: process_tile(g, *kj), product(range(nk), range(nj))
+                )
+            )
+            for i in group:
+                inp[i] = None  # no ref count -> delete array
 
-    generate_pyramid(omz, nblevels - 1, mode="mean", no_pyramid_axis=no_pool)
+    generate_pyramid(
+        omz,
+        nblevels,
+        mode="mean",
+        no_pyramid_axis=no_pool,
+        max_workers=max_workers,
+        compressed=compress_levels == "all",
+    )
 
     print("")
 
@@ -6,13 +6,14 @@ into a OME-ZARR pyramid.
 """
 
 import ast
-import json
-import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from functools import wraps
 from itertools import product
-from typing import Callable, Optional
+from typing import Callable, Literal, Optional
 from warnings import warn
 
 import cyclopts
@@ -23,9 +24,14 @@ from scipy.io import loadmat
 
 from linc_convert import utils
 from linc_convert.modalities.psoct._utils import (
-    generate_pyramid,
+    _create_levels,
+    _inline_levels,
+    _stream_levels,
+    _write_pyramid_block,
+    compressor_defaults,
     make_json,
     niftizarr_write_header,
+    write_json,
     write_ome_metadata,
 )
 from linc_convert.modalities.psoct.cli import psoct
@@ -45,11 +51,11 @@ def _automap(func: Callable) -> Callable:
     @wraps(func)
     def wrapper(inp: str, out: str, **kwargs: dict) -> None:
         if out is None:
-            out = os.path.splitext(inp[0])[0]
+            out = os.path.splitext(inp)[0]
             out += ".nii.zarr" if kwargs.get("nii", False) else ".ome.zarr"
         # kwargs["nii"] = kwargs.get("nii", False) or out.endswith(".nii.zarr")
         with _mapmat(inp, kwargs.get("key", None)) as dat:
-            return func(dat, zarr_config=zarr_config, **kwargs)
+            return func(dat, out=out, **kwargs)
 
     return wrapper
 
@@ -79,7 +85,24 @@ def _mapmat(fname: str, key: str = None) -> None:
     if key not in f.keys():
         raise Exception(f"Key {key} not found in file {fname}")
 
-    yield f.get(key)
+    dat = f.get(key)
+    if (
+        isinstance(dat, h5py.Dataset)
+        and dat.chunks is None
+        and dat.dtype.kind in "biuf"
+        and dat.id.get_offset() is not None
+    ):
+        # Contiguous (hence uncompressed) datasets are memory-mapped, so
+        # that reads go through the page cache rather than HDF5
+        dat = np.memmap(
+            fname,
+            mode="r",
+            dtype=dat.dtype,
+            offset=dat.id.get_offset(),
+            shape=dat.shape,
+        )
+
+    yield dat
     if hasattr(f, "close"):
         f.close()
 
@@ -98,7 +121,9 @@ def convert(
     no_pool: Optional[int] = None,
     orientation: str = "RAS",
     center: bool = True,
-        kwargs
+    compress_levels: Literal["all", "base", "none"] = "all",
+    max_workers: Optional[int] = None,
+    **kwargs: dict,
 ) -> None:
     """
     Matlab to OME-Zarr.
@@ -118,12 +143,18 @@ def convert(
         Path to the metadata file
     chunk
         Output chunk size
-    compressor : {blosc, zlib, raw}
-        Compression method
+    compressor : {blosc, zlib, zfp, raw}
+        Compression method (zfp: floating point data only)
     compressor_opt
-        Compression options
+        Compression options (Blosc defaults to zstd, level 3, with
+        bit shuffling; e.g. `{"shuffle": "shuffle"}` for byte shuffling.
+        ZFP defaults to `{"mode": "fixed_rate", "rate": 8}`)
+    compress_levels
+        Pyramid levels to compress: `"all"`, only the `"base"` level
+        (levels >= 1 are written uncompressed) or `"none"`.
     max_load
-        Maximum input chunk size
+        Maximum input chunk size (rounded up to a multiple of the
+        chunk size)
     max_levels
         Maximum number of pyramid levels
     no_pool
@@ -134,9 +165,12 @@ def convert(
         Orientation of the volume
     center
         Set RAS[0, 0, 0] at FOV center
+    max_workers
+        Number of input chunks processed in parallel
+        (default: number of CPUs)
     """
     zarr_config = utils.zarr.zarr_config.update(zarr_config, **kwargs)
-    chunk: int = zarr_config.chunk
+    chunk: int = zarr_config.chunk[0]
     compressor: str = zarr_config.compressor
     compressor_opt: str = zarr_config.compressor_opt
     nii: bool = zarr_config.nii
@@ -144,6 +178,16 @@ def convert(
     if isinstance(compressor_opt, str):
         compressor_opt = ast.literal_eval(compressor_opt)
 
+    # Input chunks are aligned with output chunks, so that each output
+    # chunk is written whole (no read-modify-write)
+    if max_load % chunk:
+        aligned = ceildiv(max_load, chunk) * chunk
+        warn(
+            f"max_load ({max_load}) is not a multiple of the chunk size "
+            f"({chunk}), using {aligned} instead"
+        )
+        max_load = aligned
+
     # Write OME-Zarr multiscale metadata
     if meta:
         print("Write JSON")
@@ -151,8 +195,7 @@ def convert(
             meta_txt = f.read()
             meta_json = make_json(meta_txt)
         path_json = ".".join(out.split(".")[:-2]) + ".json"
-        with open(path_json, "w") as f:
-            json.dump(meta_json, f, indent=4)
+        write_json(meta_json, path_json)
         vx = meta_json["PixelSize"]
         unit = meta_json["PixelSizeUnits"]
     else:
@@ -160,8 +203,10 @@ def convert(
         unit = "um"
 
     # Prepare Zarr group
-    omz = zarr.storage.DirectoryStore(out)
-    omz = zarr.group(store=omz, overwrite=True)
+    # (chunks are written from several threads; FSStore hands all chunks
+    #  of a write to the filesystem in a single `setitems` batch)
+    omz = zarr.storage.FSStore(out)
+    omz = zarr.group(store=omz, overwrite=True, synchronizer=zarr.ThreadSynchronizer())
 
     if not hasattr(inp, "dtype"):
         raise Exception("Input is not a numpy array. This is unexpected.")
@@ -170,51 +215,133 @@ def convert(
     # Prepare chunking options
     opt = {
         "dimension_separator": r"/",
-        "order": "F",
+        "order": "C",  # match the (C-contiguous) input and pooled arrays
         "dtype": np.dtype(inp.dtype).str,
-        "fill_value": None,
-        "compressor": make_compressor(compressor, **compressor_opt),
+        "fill_value": 0,
+        # do not store chunks that only contain background
+        "write_empty_chunks": False,
     }
+    if compress_levels == "none":
+        compressor = "raw"
+    compressor, compressor_opt = compressor_defaults(
+        compressor, compressor_opt, inp.dtype
+    )
+    opt["compressor"] = make_compressor(compressor, **compressor_opt)
+
+    # Number of levels above the base one: (x - 1).bit_length() is
+    # ceil(log2(x)), the number of halvings that bring x down to one voxel
+    nblevels = min(
+        (x - 1).bit_length() for i, x in enumerate(inp.shape) if i != no_pool
+    )
+    nblevels = max(0, min(nblevels, (max_load - 1).bit_length(), max_levels) - 1)
+
+    opt["chunks"] = [min(x, chunk) for x in inp.shape]
+
+    omz.create_dataset(str(0), shape=inp.shape, **opt)
+    allshapes = _create_levels(
+        omz,
+        nblevels,
+        no_pyramid_axis=no_pool,
+        compressed=compress_levels == "all",
+    )
+    arrays = [
+        zarr.open_array(
+            omz.store,
+            mode="r+",
+            path=str(level),
+            synchronizer=omz.synchronizer,
+            write_empty_chunks=False,
+        )
+        for level in range(len(allshapes))
+    ]
 
     inp_chunk = [min(x, max_load) for x in inp.shape]
     nk = ceildiv(inp.shape[0], inp_chunk[0])
     nj = ceildiv(inp.shape[1], inp_chunk[1])
     ni = ceildiv(inp.shape[2], inp_chunk[2])
 
-    nblevels = min(
-        [int(math.ceil(math.log2(x))) for i, x in enumerate(inp.shape) if i != no_pool]
+    # The finest levels are computed from the input chunks while they
+    # are in memory, as long as they cover whole output chunks. Coarser
+    # levels are streamed from the level above them.
+    nbinline = _inline_levels(
+        max_load, arrays[0].chunks, [nk, nj, ni], nblevels, no_pool
     )
-    nblevels = min(nblevels, int(math.ceil(math.log2(max_load))))
-    nblevels = min(nblevels, max_levels)
 
-    opt["chunks"] = [min(x, chunk) for x in inp.shape]
+    # progress is printed at most every half second
+    progress_total = f"[{nk:03d}, {nj:03d}, {ni:03d}]"
+    last_print = 0.0
 
-    omz.create_dataset(str(0), shape=inp.shape, **opt)
+    # HDF5 datasets are read straight into a (per-thread) reusable buffer
+    buffers = threading.local()
 
-    # iterate across input chunks
-    for i, j, k in product(range(ni), range(nj), range(nk)):
-        loaded_chunk = inp[
+    def read_chunk(k: int, j: int, i: int) -> np.ndarray:
+        source_sel = np.s_[
             k * inp_chunk[0] : (k + 1) * inp_chunk[0],
             j * inp_chunk[1] : (j + 1) * inp_chunk[1],
             i * inp_chunk[2] : (i + 1) * inp_chunk[2],
         ]
-
-        print(
-            f"[{i + 1:03d}, {j + 1:03d}, {k + 1:03d}]",
-            "/",
-            f"[{ni:03d}, {nj:03d}, {nk:03d}]",
-            # f"({1 + level}/{nblevels})",
-            end="\r",
+        if not hasattr(inp, "read_direct"):
+            return np.asarray(inp[source_sel])
+        if not hasattr(buffers, "buf"):
+            buffers.buf = np.empty(inp_chunk, dtype=inp.dtype)
+        dest_sel = tuple(
+            slice(0, min(sel.stop, n) - sel.start)
+            for sel, n in zip(source_sel, inp.shape)
         )
+        inp.read_direct(buffers.buf, source_sel=source_sel, dest_sel=dest_sel)
+        return buffers.buf[dest_sel]
+
+    # iterate across input chunks
+    def process_chunk(index: tuple[int, int, int]) -> None:
+        nonlocal last_print
+        k, j, i = index
+        loaded_chunk = read_chunk(k, j, i)
+
+        now = time.monotonic()
+        if now - last_print > 0.5:
+            last_print = now
+            print(
+                f"[{k + 1:03d}, {j + 1:03d}, {i + 1:03d}]",
+                "/",
+                progress_total,
+                end="\r",
+            )
 
         # save current chunk
-        omz["0"][
-            k * inp_chunk[0] : k * inp_chunk[0] + loaded_chunk.shape[0],
-            j * inp_chunk[1] : j * inp_chunk[1] + loaded_chunk.shape[1],
-            i * inp_chunk[2] : i * inp_chunk[2] + loaded_chunk.shape[2],
-        ] = loaded_chunk
+        # (plain slices: skip zarr's generic indexing dispatch)
+        arrays[0].set_basic_selection(
+            np.s_[
+                k * inp_chunk[0] : k * inp_chunk[0] + loaded_chunk.shape[0],
+                j * inp_chunk[1] : j * inp_chunk[1] + loaded_chunk.shape[1],
+                i * inp_chunk[2] : i * inp_chunk[2] + loaded_chunk.shape[2],
+            ],
+            loaded_chunk,
+        )
 
-    generate_pyramid(omz, nblevels - 1, mode="mean", no_pyramid_axis=no_pool)
+        # downsample current chunk into the inline levels
+        _write_pyramid_block(
+            arrays[: nbinline + 1],
+            loaded_chunk,
+            (k, j, i),
+            max_load,
+            allshapes,
+            mode="mean",
+            no_pyramid_axis=no_pool,
+        )
+
+    # Blosc releases the GIL, so compression of disjoint chunks overlaps.
+    # Chunks are visited in storage order (last axis fastest), so that
+    # consecutive reads hit the same input (HDF5) chunks.
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        list(executor.map(process_chunk, product(range(nk), range(nj), range(ni))))
+        _stream_levels(
+            executor,
+            arrays,
+            allshapes,
+            nbinline + 1,
+            mode="mean",
+            no_pyramid_axis=no_pool,
+        )
 
     print("")
 
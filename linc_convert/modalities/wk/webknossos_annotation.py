@@ -5,6 +5,7 @@ import ast
 import json
 import os
 import shutil
+import time
 
 import cyclopts
 import numpy as np
@@ -171,9 +172,13 @@ def convert(
                 ni = ceildiv(subdat_size[-2], max_load)
                 nj = ceildiv(subdat_size[-1], max_load)
 
+                last_print = 0.0
                 for i in range(ni):
                     for j in range(nj):
-                        print(f"\r{i+1}/{ni}, {j+1}/{nj}", end=" ")
+                        now = time.monotonic()
+                        if now - last_print > 0.5:
+                            last_print = now
+                            print(f"\r{i+1}/{ni}, {j+1}/{nj}", end=" ")
                         start_x, end_x = (i * max_load,)
                         min((i + 1) * max_load, subdat_size[-2])
 
@@ -1,8 +1,10 @@
 """Utilities for JPEG2000 files."""
 
 # stdlib
+import struct
 import uuid
 from dataclasses import dataclass
+from os import PathLike
 
 # externals
 import numpy as np
@@ -35,6 +37,78 @@ def get_pixelsize(j2k: Jp2k) -> tuple[float, float]:
     return vxw, vxh
 
 
+def read_header(path: str | PathLike) -> tuple[tuple[int, ...], np.dtype, int]:
+    """
+    Read shape, data type and number of decompositions of a JPEG2000 file.
+
+    Only the top-level box headers and the main header of the codestream
+    (up to its COD marker) are read, which is much cheaper than parsing
+    the file with `glymur.Jp2k`.
+
+    Parameters
+    ----------
+    path : str | PathLike
+        Path to a JP2 file or a raw J2K codestream.
+
+    Returns
+    -------
+    shape : tuple[int]
+        Image shape, (H, W) or (H, W, C), as returned by `glymur.Jp2k`.
+    dtype : np.dtype
+        Data type of the image components.
+    num_decomp : int
+        Number of wavelet decompositions (`num_res` in glymur's COD
+        segment).
+    """
+    with open(path, "rb") as f:
+        # Find the codestream (`jp2c` box) in a JP2 container
+        if f.read(2) != b"\xff\x4f":
+            f.seek(0)
+            while True:
+                head = f.read(8)
+                if len(head) < 8:
+                    raise ValueError(f"No codestream found in {path}")
+                length, box = struct.unpack(">I4s", head)
+                offset = 8
+                if length == 1:
+                    (length,) = struct.unpack(">Q", f.read(8))
+                    offset = 16
+                if box == b"jp2c":
+                    break
+                # (a length of zero, "up to the end of the file", is only
+                #  valid for the last box, which must be the codestream)
+                if length < offset:
+                    raise ValueError(f"Invalid {box!r} box length in {path}")
+                f.seek(length - offset, 1)
+            if f.read(2) != b"\xff\x4f":
+                raise ValueError(f"Invalid codestream in {path}")
+
+        # Walk the main header markers until COD
+        shape = dtype = None
+        while True:
+            marker, length = struct.unpack(">HH", f.read(4))
+            segment = f.read(length - 2)
+            if marker == 0xFF51:  # SIZ
+                xsiz, ysiz, xosiz, yosiz = struct.unpack(">4I", segment[2:18])
+                (ncomp,) = struct.unpack(">H", segment[34:36])
+                ssiz = segment[36]
+                shape = (ysiz - yosiz, xsiz - xosiz)
+                if ncomp > 1:
+                    shape += (ncomp,)
+                signed, bitdepth = ssiz & 0x80, (ssiz & 0x7F) + 1
+                if bitdepth <= 8:
+                    dtype = np.dtype(np.int8 if signed else np.uint8)
+                else:
+                    dtype = np.dtype(np.int16 if signed else np.uint16)
+            elif marker == 0xFF52:  # COD
+                num_decomp = segment[5]
+                break
+            elif marker == 0xFF90:  # SOT: end of main header
+                raise ValueError(f"No COD marker found in {path}")
+
+    return shape, dtype, num_decomp
+
+
 @dataclass
 class WrappedJ2K:
     """
@@ -129,7 +203,11 @@ class WrappedJ2K:
 
         data = self.j2k.read(rlevel=self.level, area=area)
         if cidx:
-            data = data[:, :, cidx[0]]
+            # glymur returns a freshly allocated (H, W, C) array: only
+            # take a channel subset when asked, and return a view
+            # (no copy) in channel-first order.
+            if cidx[0] != slice(None):
+                data = data[:, :, cidx[0]]
             if self.channel_first:
                 data = np.transpose(data, [2, 0, 1])
         return data
@@ -3,17 +3,39 @@
 import numcodecs
 import numcodecs.abc
 
+try:
+    import zfpy
+    from numcodecs.zfpy import ZFPY
+except ImportError:
+    zfpy = ZFPY = None
 
-def make_compressor(name: str, **prm: dict) -> numcodecs.abc.Codec:
-    """Build compressor object from name and options."""
+
+def make_compressor(name: str, **prm: dict) -> numcodecs.abc.Codec | None:
+    """Build compressor object from name and options (`"raw"`: none)."""
     # TODO: we should use `numcodecs.get_codec` instead`
     if not isinstance(name, str):
         return name
     name = name.lower()
+    if name == "raw":
+        return None
     if name == "blosc":
         Compressor = numcodecs.Blosc
+        # shuffle filters can be given by name ("bitshuffle", ...)
+        shuffle = prm.get("shuffle")
+        if isinstance(shuffle, str):
+            shuffle = shuffle.upper()
+            if shuffle not in ("NOSHUFFLE", "SHUFFLE", "BITSHUFFLE", "AUTOSHUFFLE"):
+                raise ValueError("Unknown shuffle", prm["shuffle"])
+            prm["shuffle"] = getattr(numcodecs.Blosc, shuffle)
     elif name == "zlib":
         Compressor = numcodecs.Zlib
+    elif name == "zfp":
+        if ZFPY is None:
+            raise ImportError("The zfp compressor requires zfpy (linc-convert[zfp])")
+        Compressor = ZFPY
+        # modes can be given by name ("fixed_rate", ...)
+        if isinstance(prm.get("mode"), str):
+            prm["mode"] = getattr(zfpy, "mode_" + prm["mode"].lower())
     else:
         raise ValueError("Unknown compressor", name)
     return Compressor(**prm)
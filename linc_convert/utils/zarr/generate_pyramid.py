@@ -1,4 +1,5 @@
 import itertools
+import time
 from typing import Literal
 
 import numpy as np
@@ -93,8 +94,12 @@ def generate_pyramid(
         # Iterate across `max_load` chunks
         # (note that these are unrelated to underlying zarr chunks)
         grid_shape = [ceildiv(n, max_load) for n in prev_shape]
+        last_print = 0.0
         for chunk_index in itertools.product(*[range(x) for x in grid_shape]):
-            print(f"chunk {chunk_index} / {tuple(grid_shape)})", end="\r")
+            now = time.monotonic()
+            if now - last_print > 0.5:
+                last_print = now
+                print(f"chunk {chunk_index} / {tuple(grid_shape)})", end="\r")
 
             # Read one chunk of data at the previous resolution
             slicer = [Ellipsis] + [
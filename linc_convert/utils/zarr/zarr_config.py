@@ -26,7 +26,7 @@ class _ZarrConfig:
         assuming a compression ratio or 2.
     version
         Zarr version to use. If `shard` is used, 3 is required.
-    compressor : {blosc, zlib|gzip, raw}
+    compressor : {blosc, zlib|gzip, zfp, raw}
         Compression method
     compressor_opt
         Compression options
@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+
+from linc_convert.utils.zarr.compressor import make_compressor
+
+
+@pytest.mark.parametrize("mode", ["fixed_rate", "FIXED_RATE"])
+def test_zfp(mode):
+    zfpy = pytest.importorskip("zfpy")
+    codec = make_compressor("zfp", mode=mode, rate=8)
+    assert codec.mode == zfpy.mode_fixed_rate
+    dat = np.linspace(0, 1, 4096, dtype=np.float32).reshape(16, 16, 16)
+    buf = codec.encode(dat)
+    assert len(buf) < dat.nbytes
+    np.testing.assert_allclose(codec.decode(buf).reshape(dat.shape), dat, atol=1e-2)
@@ -1,9 +1,13 @@
 import glob
 import os
+import tempfile
 import zipfile
 
+import fsspec
 import glymur
 import numpy as np
+import pytest
+import zarr
 
 from helper import _cmp_zarr_archives
 from linc_convert.modalities.df import multi_slice
@@ -27,3 +31,111 @@ def test_df(tmp_path):
     files.sort()
     multi_slice.convert(files, out=str(output_zarr))
     assert _cmp_zarr_archives(str(output_zarr), "data/df.zarr.zip")
+
+
+@pytest.mark.parametrize("max_workers", [None, 1])
+def test_df_rgba(tmp_path, max_workers):
+    # the alpha component of RGBA slices is dropped
+    rng = np.random.default_rng(0)
+    images = []
+    for idx in range(2):
+        image = rng.integers(0, 256, (200, 240, 4), dtype=np.uint8)
+        glymur.Jp2k(str(tmp_path / f"{idx}.jp2"), data=image)
+        images.append(image)
+    output_zarr = tmp_path / "output.zarr"
+    files = sorted(glob.glob(os.path.join(tmp_path, "*.jp2")))
+    multi_slice.convert(files, out=str(output_zarr), max_workers=max_workers)
+    level0 = zarr.open(str(output_zarr), mode="r")["0"][:]
+    expected = np.stack([image[..., :3].transpose(2, 0, 1) for image in images], 1)
+    assert level0.shape == (3, 2, 200, 240)
+    assert np.array_equal(level0, expected)
+
+
+def _write_slices(directory, shape, dtype=np.uint8, nslices=2):
+    rng = np.random.default_rng(0)
+    images = []
+    for idx in range(nslices):
+        image = rng.integers(0, np.iinfo(dtype).max, shape, dtype=dtype)
+        glymur.Jp2k(str(directory / f"{idx}.jp2"), data=image)
+        images.append(image)
+    files = sorted(glob.glob(os.path.join(directory, "*.jp2")))
+    return files, images
+
+
+@pytest.mark.parametrize(
+    "shape,dtype,chunk",
+    [((200, 240, 3), np.uint8, 64), ((200, 240), np.uint16, 32)],
+)
+def test_df_target_chunk_bytes(tmp_path, shape, dtype, chunk):
+    files, _ = _write_slices(tmp_path, shape, dtype)
+    output_zarr = tmp_path / "output.zarr"
+    nbytes = np.prod(shape[2:], dtype=int) * np.dtype(dtype).itemsize * chunk**2
+    multi_slice.convert(files, out=str(output_zarr), target_chunk_bytes=nbytes)
+    omz = zarr.open(str(output_zarr), mode="r")
+    assert omz["0"].chunks == (*shape[2:], 1, chunk, chunk)
+
+
+@pytest.mark.parametrize("compress_levels", ["all", "base", "none"])
+def test_df_compress_levels(tmp_path, compress_levels):
+    files, _ = _write_slices(tmp_path, (200, 240, 3))
+    output_zarr = tmp_path / "output.zarr"
+    multi_slice.convert(files, out=str(output_zarr), compress_levels=compress_levels)
+    omz = zarr.open(str(output_zarr), mode="r")
+    levels = sorted(set(omz.array_keys()) - {"nifti"})
+    assert len(levels) > 1
+    for level in levels:
+        compressed = compress_levels == "all" or (
+            compress_levels == "base" and level == "0"
+        )
+        assert (omz[level].compressor is not None) == compressed
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_df_gray(tmp_path, dtype):
+    # single-component slices have no channel axis
+    files, images = _write_slices(tmp_path, (200, 240), dtype)
+    output_zarr = tmp_path / "output.zarr"
+    multi_slice.convert(files, out=str(output_zarr), max_load=64)
+    omz = zarr.open(str(output_zarr), mode="r")
+    assert omz["0"].shape == (2, 200, 240)
+    assert omz["0"].dtype == dtype
+    assert np.array_equal(omz["0"][:], np.stack(images))
+    assert omz["1"].shape == (2, 100, 120)
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_df_remote(tmp_path, monkeypatch, fail):
+    # remote outputs are staged locally, uploaded, then the staging
+    # directory is removed (even if the conversion fails)
+    files, images = _write_slices(tmp_path, (200, 240, 3))
+    staging = []
+    make_staging = tempfile.TemporaryDirectory
+    monkeypatch.setattr(
+        multi_slice.tempfile,
+        "TemporaryDirectory",
+        lambda: staging.append(make_staging(dir=tmp_path)) or staging[-1],
+    )
+    if fail:
+
+        def consolidate(store):
+            raise RuntimeError("conversion failed")
+
+        monkeypatch.setattr(multi_slice.zarr, "consolidate_metadata", consolidate)
+
+    fs = fsspec.filesystem("memory")
+    out = f"memory://test_df_remote_{fail}/output.zarr"
+    try:
+        if fail:
+            with pytest.raises(RuntimeError):
+                multi_slice.convert(files, out=out)
+        else:
+            multi_slice.convert(files, out=out)
+            level0 = zarr.open_consolidated(fs.get_mapper(out), mode="r")["0"]
+            expected = np.stack([image.transpose(2, 0, 1) for image in images], 1)
+            assert np.array_equal(level0[:], expected)
+            assert fs.exists(f"memory://test_df_remote_{fail}/output.json")
+        assert len(staging) == 1
+        assert not os.path.exists(staging[0].name)
+    finally:
+        if fs.exists(f"memory://test_df_remote_{fail}"):
+            fs.rm(f"memory://test_df_remote_{fail}", recursive=True)
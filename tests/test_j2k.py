@@ -0,0 +1,45 @@
+import struct
+
+import glymur
+import numpy as np
+import pytest
+
+from linc_convert.utils.j2k import read_header
+
+
+@pytest.mark.parametrize("ext", ["jp2", "j2k"])
+@pytest.mark.parametrize(
+    "shape,dtype",
+    [
+        ((60, 80), np.uint8),
+        ((60, 80, 3), np.uint8),
+        ((60, 80, 4), np.uint8),
+        ((60, 80), np.uint16),
+        ((60, 80, 3), np.uint16),
+    ],
+)
+def test_read_header(tmp_path, ext, shape, dtype):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, np.iinfo(dtype).max, shape, dtype=dtype)
+    path = str(tmp_path / f"image.{ext}")
+    glymur.Jp2k(path, data=data, numres=4)
+
+    j2k = glymur.Jp2k(path)
+    header_shape, header_dtype, num_decomp = read_header(path)
+    assert header_shape == j2k.shape
+    assert header_dtype == j2k.dtype
+    assert num_decomp == j2k.codestream.segment[2].num_res == 3
+
+
+@pytest.mark.parametrize("length", [0, 4])
+def test_read_header_bad_box(tmp_path, length):
+    # signature box, then a box whose length is shorter than its header
+    path = tmp_path / "image.jp2"
+    path.write_bytes(
+        struct.pack(">I4s", 12, b"jP  ")
+        + b"\r\n\x87\n"
+        + struct.pack(">I4s", length, b"ftyp")
+        + bytes(12)
+    )
+    with pytest.raises(ValueError):
+        read_header(str(path))
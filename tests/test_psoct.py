@@ -0,0 +1,258 @@
+import h5py
+import numpy as np
+import pytest
+import zarr
+from scipy.io import savemat
+
+from linc_convert.modalities.psoct import _utils, multi_slice, single_volume
+from linc_convert.utils.zarr.zarr_config import ZarrConfig
+
+
+def _ref_pool(dat, mode="mean", no_pool=None):
+    # plain numpy 2x2x2 mean/median (2x2 across `no_pool`), in float64
+    shape = dat.shape
+    windows = [1 if i == no_pool or n < 2 else 2 for i, n in enumerate(shape)]
+    dat = dat[tuple(slice(n - n % w) for n, w in zip(shape, windows))]
+    dat = dat.astype(np.float64).reshape(
+        [x for n, w in zip(dat.shape, windows) for x in (n // w, w)]
+    )
+    dat = dat.transpose([0, 2, 4, 1, 3, 5]).reshape(dat.shape[::2] + (-1,))
+    return np.mean(dat, -1) if mode == "mean" else np.median(dat, -1)
+
+
+def _assert_pooled(out, ref, dtype):
+    assert out.dtype == dtype
+    assert out.shape == ref.shape
+    if np.issubdtype(dtype, np.integer):
+        # paths may round or truncate
+        np.testing.assert_allclose(out, ref, atol=1)
+    else:
+        np.testing.assert_allclose(out, ref, rtol=1e-5)
+
+
+def _random(shape, dtype, seed=0):
+    return (np.random.default_rng(seed).random(shape) * 1000).astype(dtype)
+
+
+SHAPES = [(7, 9, 5), (8, 6, 10)]
+DTYPES = [np.uint16, np.int16, np.float32]
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("no_pool", [None, 0, 1, 2])
+def test_downsample_numba(monkeypatch, shape, dtype, no_pool):
+    if _utils.numba is None:
+        pytest.skip("numba not installed")
+    calls = []
+    kernel = _utils._POOL_MEAN[no_pool]
+    monkeypatch.setitem(
+        _utils._POOL_MEAN,
+        no_pool,
+        lambda *args: calls.append(1) or kernel(*args),
+    )
+    dat = _random(shape, dtype)
+    out = _utils._downsample(dat, shape, mode="mean", no_pyramid_axis=no_pool)
+    assert calls
+    _assert_pooled(out, _ref_pool(dat, no_pool=no_pool), dtype)
+
+
+@pytest.mark.parametrize("shape", SHAPES + [(5, 1, 7)])
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("no_pool", [None, 1])
+@pytest.mark.parametrize("mode", ["mean", "median"])
+def test_downsample_numpy(monkeypatch, shape, dtype, no_pool, mode):
+    monkeypatch.setattr(_utils, "numba", None)
+    dat = _random(shape, dtype)
+    out = _utils._downsample(dat, shape, mode=mode, no_pyramid_axis=no_pool)
+    _assert_pooled(out, _ref_pool(dat, mode, no_pool), dtype)
+
+
+def test_inline_levels():
+    # blocks of 64 voxels cover whole chunks of levels 1 and 2 only
+    assert _utils._inline_levels(64, (16, 16, 16), [2, 1, 1], 4) == 2
+    assert _utils._inline_levels(16, (16, 16, 16), [5, 4, 3], 4) == 0
+    # axes that are not split into blocks do not constrain levels
+    assert _utils._inline_levels(64, (16, 16, 16), [1, 1, 1], 4) == 4
+
+
+def _make_base(shape, chunks, dtype=np.float32):
+    omz = zarr.group(store=zarr.MemoryStore())
+    omz.create_dataset("0", data=_random(shape, dtype), chunks=chunks)
+    return omz
+
+
+@pytest.mark.parametrize("max_load", [16, 64])  # streamed / inline levels
+@pytest.mark.parametrize("max_workers", [1, 4])
+@pytest.mark.parametrize("no_pool", [None, 1])
+@pytest.mark.parametrize("compressed", [True, False])
+def test_generate_pyramid(max_load, max_workers, no_pool, compressed):
+    omz = _make_base((70, 50, 37), chunks=(16, 16, 16))
+    shapes = _utils.generate_pyramid(
+        omz,
+        3,
+        max_load=max_load,
+        mode="mean",
+        no_pyramid_axis=no_pool,
+        max_workers=max_workers,
+        compressed=compressed,
+    )
+    assert len(shapes) == 4
+    ref = omz["0"][:]
+    for level in range(1, 4):
+        ref = _ref_pool(ref, no_pool=no_pool).astype(np.float32)
+        array = omz[str(level)]
+        assert list(array.shape) == shapes[level]
+        assert (array.compressor is not None) == compressed
+        _assert_pooled(array[:], ref, np.float32)
+
+
+@pytest.mark.parametrize("nslices", [75, 100, 128])
+def test_generate_pyramid_block_size(monkeypatch, nslices):
+    # chunks that span a whole axis must not inflate blocks
+    blocks = []
+    write_block = _utils._write_pyramid_block
+    monkeypatch.setattr(
+        _utils,
+        "_write_pyramid_block",
+        lambda arrays, dat, *args, **kwargs: (
+            blocks.append(dat.shape) or write_block(arrays, dat, *args, **kwargs)
+        ),
+    )
+    omz = _make_base((300, 260, nslices), (64, 64, min(nslices, 128)), np.uint8)
+    _utils.generate_pyramid(omz, 2, max_load=128, mode="mean")
+    assert blocks
+    assert max(max(shape) for shape in blocks) <= 128
+
+
+@pytest.mark.parametrize("compress_levels", ["all", "base", "none"])
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_multi_slice_options(tmp_path, compress_levels, max_workers):
+    vol = _random((40, 33, 21), np.uint16)
+    files = []
+    for idx in range(vol.shape[-1]):
+        fname = str(tmp_path / f"slice_{idx}.mat")
+        with h5py.File(fname, "w") as f:
+            f["data"] = vol[..., idx]
+        files.append(fname)
+    out = str(tmp_path / "out.ome.zarr")
+    multi_slice.convert(
+        files,
+        out=out,
+        max_load=16,
+        max_levels=3,
+        compress_levels=compress_levels,
+        max_workers=max_workers,
+        zarr_config=ZarrConfig(chunk=(8,)),
+    )
+    omz = zarr.open(out, mode="r")
+    assert np.array_equal(omz["0"][:], vol)
+    assert (omz["0"].compressor is not None) == (compress_levels != "none")
+    assert (omz["1"].compressor is not None) == (compress_levels == "all")
+    ref = vol
+    for level in range(1, len(list(omz.array_keys()))):
+        ref = _ref_pool(ref).astype(np.uint16)
+        np.testing.assert_allclose(omz[str(level)][:], ref, atol=level)
+
+
+def test_multi_slice_v5(tmp_path):
+    # old-style .mat files are loaded whole and written slice by slice
+    vol = _random((40, 33, 21), np.uint16)
+    files = []
+    for idx in range(vol.shape[-1]):
+        fname = str(tmp_path / f"slice_{idx}.mat")
+        savemat(fname, {"data": vol[..., idx]})
+        files.append(fname)
+    out = str(tmp_path / "out.ome.zarr")
+    multi_slice.convert(files, out=out, max_load=16, zarr_config=ZarrConfig(chunk=(8,)))
+    assert np.array_equal(zarr.open(out, mode="r")["0"][:], vol)
+
+
+def test_compressor_defaults_zfp():
+    assert _utils.compressor_defaults("zfp", {"rate": 4}, "<f4") == (
+        "zfp",
+        {"rate": 4, "mode": "fixed_rate"},
+    )
+    # integer data falls back to Blosc
+    with pytest.warns(UserWarning):
+        compressor, opt = _utils.compressor_defaults("zfp", {"rate": 4}, "<u2")
+    assert compressor == "blosc"
+    assert opt["cname"] == "zstd"
+
+
+def test_multi_slice_zfp(tmp_path):
+    pytest.importorskip("zfpy")
+    vol = _random((40, 33, 21), np.float32)
+    files = []
+    for idx in range(vol.shape[-1]):
+        fname = str(tmp_path / f"slice_{idx}.mat")
+        with h5py.File(fname, "w") as f:
+            f["data"] = vol[..., idx]
+        files.append(fname)
+    out = str(tmp_path / "out.ome.zarr")
+    multi_slice.convert(
+        files,
+        out=out,
+        max_load=16,
+        zarr_config=ZarrConfig(chunk=(8,), compressor="zfp"),
+    )
+    omz = zarr.open(out, mode="r")
+    assert omz["0"].compressor.codec_id == "zfpy"
+    # fixed rate 8: lossy, within a few percent of the value range
+    np.testing.assert_allclose(omz["0"][:], vol, atol=50)
+
+
+def test_make_json():
+    # output of the original (regex per key) parser on the example
+    example = _utils.make_json.__doc__.split("---------------")[1]
+    assert _utils.make_json(example) == {
+        "BodyPart": "BRAIN",
+        "Environment": "exvivo",
+        "SampleStaining": "none",
+        "SampleMedium": "60% 2,2' Thiodiethanol (TDE)",
+        "Wavelength": 1294.84,
+        "WavelengthUnit": "nm",
+        "ResolutionAxial": 4.9,
+        "ResolutionAxialUnit": "um",
+        "ResolutionLateral": 4.92,
+        "ResolutionLateralUnit": "um",
+        "PixelSize": [3.0, 3.0, 3.0],
+        "PixelSizeUnits": "um",
+        "DepthFocusRange": 225.0,
+        "DepthFocusRangeUnit": "um",
+        "FocusCount": 2,
+        "SliceThickness": 450.0,
+        "SliceCount": 75,
+        "OCTModality": "dBI",
+    }
+
+
+@pytest.mark.parametrize("layout", ["contiguous", "chunked", "v5"])
+@pytest.mark.parametrize("max_load", [16, 32])  # streamed / inline levels
+def test_single_volume(tmp_path, layout, max_load):
+    # contiguous HDF5 datasets are memory-mapped, chunked ones are read
+    # with `read_direct`, and old-style .mat files are loaded whole
+    vol = _random((40, 33, 21), np.uint16)
+    fname = str(tmp_path / "volume.mat")
+    if layout == "v5":
+        savemat(fname, {"data": vol})
+    else:
+        with h5py.File(fname, "w") as f:
+            f.create_dataset(
+                "data", data=vol, chunks=(8, 8, 8) if layout == "chunked" else None
+            )
+    out = str(tmp_path / "out.ome.zarr")
+    single_volume.convert(
+        fname,
+        out=out,
+        max_load=max_load,
+        max_levels=3,
+        zarr_config=ZarrConfig(chunk=(8,)),
+    )
+    omz = zarr.open(out, mode="r")
+    assert np.array_equal(omz["0"][:], vol)
+    assert len(list(omz.array_keys())) == 3
+    ref = vol
+    for level in range(1, 3):
+        ref = _ref_pool(ref).astype(np.uint16)
+        np.testing.assert_allclose(omz[str(level)][:], ref, atol=level)